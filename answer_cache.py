@@ -0,0 +1,155 @@
+import os
+import time
+import asyncio
+import logging
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Configuration for the semantic answer cache
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "true").lower() == "true"
+ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.95"))
+ANSWER_CACHE_TTL = int(os.getenv("ANSWER_CACHE_TTL", "86400"))
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "5000"))
+ANSWER_CACHE_SHARED = os.getenv("ANSWER_CACHE_SHARED", "false").lower() == "true"
+
+
+def _normalize(vector):
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+class SemanticAnswerCache:
+    # Answers keyed on the query embedding: a question whose cosine similarity to a
+    # stored one is above `threshold` gets the stored answer back. Entries live in an
+    # in-process LRU with a TTL, optionally backed by a shared Mongo collection that
+    # is looked up by exact question key (see embedding_cache.cache_key) only.
+    # `namespace` must change whenever the index or the prompt changes.
+    def __init__(self, namespace: str, threshold: float = ANSWER_CACHE_THRESHOLD,
+                 ttl: int = ANSWER_CACHE_TTL, max_entries: int = ANSWER_CACHE_MAX_ENTRIES,
+                 collection=None):
+        self.namespace = namespace
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.collection = collection
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        # Entries live in fixed slots: row i of _matrix, _answers[i] and _expires[i].
+        # A put overwrites one row, reusing the least recently used slot when full,
+        # so lookups never re-stack the cache.
+        self._matrix = None  # (max_entries, dim), allocated on the first put
+        self._answers = [None] * max_entries
+        self._expires = np.zeros(max_entries)  # monotonic expiry; 0 marks an empty slot
+        self._size = 0  # slots in use so far; rows past it are never scanned
+        self._lru = OrderedDict()  # slot -> None, least recently used first
+        self._lock = threading.Lock()
+
+    def _lookup_local(self, vector, threshold: float):
+        with self._lock:
+            if not self._size:
+                return None
+            now = time.monotonic()
+            scores = self._matrix[:self._size] @ vector
+            scores[self._expires[:self._size] <= now] = -np.inf
+            best = int(np.argmax(scores))
+            if scores[best] < threshold:
+                return None
+            self._lru.move_to_end(best)
+            return self._answers[best]
+
+    def _store_local(self, vector, answer: str):
+        with self._lock:
+            if self._matrix is None:
+                self._matrix = np.empty((self.max_entries, vector.shape[0]), dtype=np.float32)
+            if self._size < self.max_entries:
+                slot = self._size
+                self._size += 1
+            else:
+                slot, _ = self._lru.popitem(last=False)
+            self._matrix[slot] = vector
+            self._answers[slot] = answer
+            self._expires[slot] = time.monotonic() + self.ttl
+            self._lru[slot] = None
+            self._lru.move_to_end(slot)
+
+    def get(self, vector):
+        vector = _normalize(vector)
+        answer = self._lookup_local(vector, self.threshold)
+        if answer is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return answer
+
+    def put(self, vector, answer: str):
+        self._store_local(_normalize(vector), answer)
+
+    async def aget(self, vector, key: str = None, threshold: float = None):
+        # A lower threshold accepts looser matches, e.g. as a fallback while the LLM is unavailable
+        threshold = self.threshold if threshold is None else threshold
+        vector = _normalize(vector)
+        # The scan is a (entries x dim) matrix product; keep it off the event loop
+        answer = await asyncio.to_thread(self._lookup_local, vector, threshold)
+        if answer is None and self.collection is not None and key is not None:
+            answer = await self._lookup_shared(key)
+            if answer is not None:
+                self.shared_hits += 1
+                self._store_local(vector, answer)
+        if answer is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return answer
+
+    async def aput(self, vector, answer: str, key: str = None):
+        vector = _normalize(vector)
+        self._store_local(vector, answer)
+        if self.collection is None or key is None:
+            return
+        now = datetime.now(timezone.utc)
+        try:
+            await self.collection.insert_one({
+                "namespace": self.namespace,
+                "key": key,
+                "answer": answer,
+                "created_at": now,
+                "expires_at": now + timedelta(seconds=self.ttl),
+            })
+        except Exception as e:
+            logger.error(f"Error storing answer in shared cache: {e}")
+
+    async def _lookup_shared(self, key: str):
+        # One indexed point lookup; similarity matching stays in the local tier
+        try:
+            doc = await self.collection.find_one(
+                {"namespace": self.namespace, "key": key, "expires_at": {"$gt": datetime.now(timezone.utc)}},
+                {"_id": 0, "answer": 1},
+                sort=[("created_at", -1)],
+            )
+        except Exception as e:
+            logger.error(f"Error reading shared answer cache: {e}")
+            return None
+        return doc["answer"] if doc else None
+
+    async def ensure_indexes(self):
+        if self.collection is None:
+            return
+        await self.collection.create_index("expires_at", expireAfterSeconds=0)
+        await self.collection.create_index([("namespace", 1), ("key", 1), ("created_at", -1)])
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "namespace": self.namespace,
+            "entries": len(self._lru),
+            "hits": self.hits,
+            "shared_hits": self.shared_hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
@@ -3,7 +3,12 @@ from google.oauth2 import id_token
 from fastapi import HTTPException, status, APIRouter, Request
 from fastapi.responses import RedirectResponse
 import os
-from models import User
+import re
+import time
+import asyncio
+import threading
+from database import User
+from sessions import issue_token, SESSION_TOKEN_TTL
 import logging
 
 # Environment variables
@@ -14,6 +19,35 @@ REDIRECT_URI = os.getenv("REDIRECT_URI")
 router = APIRouter()
 logger = logging.getLogger(__name__)
 
+_MAX_AGE = re.compile(r"max-age=(\d+)")
+
+
+class CachingRequest:
+    # google-auth transport that keeps GET responses (Google's signing certs) for
+    # as long as their Cache-Control max-age allows, instead of fetching them on
+    # every login
+    def __init__(self):
+        self._request = requests.Request()
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, url, method="GET", body=None, headers=None, timeout=120, **kwargs):
+        if method != "GET" or body is not None:
+            return self._request(url, method=method, body=body, headers=headers, timeout=timeout, **kwargs)
+        with self._lock:
+            cached = self._cache.get(url)
+        if cached is not None and cached[0] > time.monotonic():
+            return cached[1]
+        response = self._request(url, method=method, headers=headers, timeout=timeout, **kwargs)
+        max_age = _MAX_AGE.search(response.headers.get("cache-control", ""))
+        if response.status == 200 and max_age:
+            with self._lock:
+                self._cache[url] = (time.monotonic() + int(max_age.group(1)), response)
+        return response
+
+
+google_request = CachingRequest()
+
 # Route to initiate Google OAuth2 login
 @router.get("/login")
 async def login():
@@ -35,11 +69,18 @@ async def auth_callback(request: Request):
             detail="Authorization code not found in the request"
         )
     try:
-        id_info = id_token.verify_oauth2_token(code, requests.Request(), GOOGLE_CLIENT_ID)
-        
-        user = User.get_user_by_google_id(id_info["sub"]) or User.create_user(google_user_id=id_info["sub"], email=id_info.get("email"))
-        
-        return {"message": "User authenticated successfully", "user": user}
+        # Verification may fetch certs on a cache miss, so it stays off the event loop
+        id_info = await asyncio.to_thread(id_token.verify_oauth2_token, code, google_request, GOOGLE_CLIENT_ID)
+
+        user = await User.get_or_create_user(google_user_id=id_info["sub"], email=id_info.get("email"))
+
+        return {
+            "message": "User authenticated successfully",
+            "user": user,
+            "session_token": issue_token(user),
+            "token_type": "bearer",
+            "expires_in": SESSION_TOKEN_TTL,
+        }
     except Exception as e:
         logger.error(f"Error in user authentication: {e}")
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="An error occurred while authenticating")
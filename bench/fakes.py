@@ -0,0 +1,422 @@
+import json
+import time
+import asyncio
+import hashlib
+from copy import deepcopy
+from typing import Any, List, Optional
+import numpy as np
+from bson import ObjectId
+from pymongo import InsertOne, UpdateOne, UpdateMany, DeleteOne
+from pymongo.errors import DuplicateKeyError
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.llms import LLM
+from langchain_core.outputs import GenerationChunk
+
+# Deterministic local stand-ins for OpenAI, Pinecone, MongoDB, Google and Stripe.
+# Every fake takes a latency so benchmarks can model the real upstreams without
+# calling (or paying for) them.
+
+
+def _seed(text: str) -> int:
+    return int.from_bytes(hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+class FakeEmbeddings(Embeddings):
+    def __init__(self, dim: int = 1536, latency: float = 0.05):
+        self.dim = dim
+        self.latency = latency
+        self.calls = 0
+
+    def _vector(self, text: str) -> List[float]:
+        vector = np.random.default_rng(_seed(text)).standard_normal(self.dim).astype(np.float32)
+        return (vector / np.linalg.norm(vector)).tolist()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        self.calls += 1
+        time.sleep(self.latency)
+        return [self._vector(t) for t in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        return [self._vector(t) for t in texts]
+
+    async def aembed_query(self, text: str) -> List[float]:
+        return (await self.aembed_documents([text]))[0]
+
+
+class FakeVectorStore:
+    # Returns k synthetic passages chosen deterministically from the query vector.
+    # Consecutive passages come in near-identical pairs, like overlapping textbooks.
+    def __init__(self, latency: float = 0.08, corpus_size: int = 10000, passage_words: int = 150,
+                 dim: int = 1536):
+        self.latency = latency
+        self.corpus_size = corpus_size
+        self.passage_words = passage_words
+        self.dim = dim
+        self.calls = 0
+
+    def _vector(self, row: int):
+        base = np.random.default_rng(row // 2).standard_normal(self.dim)
+        noise = np.random.default_rng(row).standard_normal(self.dim) * 0.05
+        return (base + noise).astype(np.float32)
+
+    def _document(self, row: int) -> Document:
+        words = " ".join(f"term{(row * 31 + i) % 997}" for i in range(self.passage_words))
+        return Document(page_content=f"Passage {row}. {words}", metadata={"id": f"doc-{row}"})
+
+    def similarity_search_by_vector_with_score(self, embedding, k: int = 4, **kwargs):
+        self.calls += 1
+        time.sleep(self.latency)
+        start = _seed(repr(embedding[:8])) % self.corpus_size
+        return [(self._document((start + i) % self.corpus_size), 1.0 - i * 0.01) for i in range(k)]
+
+    def similarity_search_by_vector(self, embedding, k: int = 4, **kwargs):
+        return [doc for doc, _ in self.similarity_search_by_vector_with_score(embedding, k)]
+
+    def search_with_vectors(self, embedding, k: int = 4):
+        self.calls += 1
+        time.sleep(self.latency)
+        start = _seed(repr(embedding[:8])) % self.corpus_size
+        rows = [(start + i) % self.corpus_size for i in range(k)]
+        return [self._document(row) for row in rows], np.stack([self._vector(row) for row in rows])
+
+
+class FakeLLM(LLM):
+    # `latency` is the time to first token; every further token adds `token_latency`
+    latency: float = 0.5
+    token_latency: float = 0.005
+    tokens: int = 200
+    calls: int = 0
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake"
+
+    def _words(self, prompt: str):
+        digest = hashlib.blake2b(prompt.encode("utf-8"), digest_size=4).hexdigest()
+        return [f"Answer {digest}:"] + [f"word{i}" for i in range(self.tokens - 1)]
+
+    def _call(self, prompt: str, stop: Optional[List[str]] = None, run_manager=None, **kwargs: Any) -> str:
+        self.calls += 1
+        time.sleep(self.latency + self.token_latency * self.tokens)
+        return " ".join(self._words(prompt))
+
+    async def _acall(self, prompt: str, stop: Optional[List[str]] = None, run_manager=None, **kwargs: Any) -> str:
+        self.calls += 1
+        await asyncio.sleep(self.latency + self.token_latency * self.tokens)
+        return " ".join(self._words(prompt))
+
+    async def _astream(self, prompt: str, stop: Optional[List[str]] = None, run_manager=None, **kwargs: Any):
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        for i, word in enumerate(self._words(prompt)):
+            if i:
+                await asyncio.sleep(self.token_latency)
+            yield GenerationChunk(text=word if i == 0 else " " + word)
+
+
+class _Result:
+    def __init__(self, **fields):
+        self.__dict__.update(fields)
+
+
+def _compare(op: str, value, expected) -> bool:
+    if op == "$ne":
+        return value != expected
+    if op == "$in":
+        return value in expected
+    if op == "$nin":
+        return value not in expected
+    if op == "$exists":
+        return (value is not None) == expected
+    if value is None:
+        return False
+    if op == "$lt":
+        return value < expected
+    if op == "$lte":
+        return value <= expected
+    if op == "$gt":
+        return value > expected
+    if op == "$gte":
+        return value >= expected
+    raise NotImplementedError(f"Fake Mongo does not support {op}")
+
+
+def _matches(doc: dict, query: Optional[dict]) -> bool:
+    for field, condition in (query or {}).items():
+        if field == "$or":
+            if not any(_matches(doc, sub) for sub in condition):
+                return False
+            continue
+        value = doc.get(field)
+        if isinstance(condition, dict) and condition and all(k.startswith("$") for k in condition):
+            if not all(_compare(op, value, expected) for op, expected in condition.items()):
+                return False
+        elif value != condition:
+            return False
+    return True
+
+
+def _project(doc: dict, projection: Optional[dict]) -> dict:
+    doc = deepcopy(doc)
+    if not projection:
+        return doc
+    included = {k for k, v in projection.items() if v and k != "_id"}
+    if included:
+        doc = {k: v for k, v in doc.items() if k in included or k == "_id"}
+    else:
+        doc = {k: v for k, v in doc.items() if projection.get(k, 1)}
+    if not projection.get("_id", 1):
+        doc.pop("_id", None)
+    return doc
+
+
+class FakeCursor:
+    def __init__(self, collection, query, projection):
+        self._collection = collection
+        self._query = query
+        self._projection = projection
+        self._sort = []
+        self._limit = 0
+
+    def sort(self, key, direction: int = 1):
+        self._sort = key if isinstance(key, list) else [(key, direction)]
+        return self
+
+    def limit(self, count: int):
+        self._limit = count
+        return self
+
+    async def to_list(self, length: Optional[int] = None):
+        await self._collection._delay()
+        docs = [d for d in self._collection._candidates(self._query) if _matches(d, self._query)]
+        for key, direction in reversed(self._sort):
+            docs.sort(key=lambda d: (d.get(key) is None, d.get(key)), reverse=direction < 0)
+        limit = min(x for x in (self._limit, length) if x) if (self._limit or length) else None
+        return [_project(d, self._projection) for d in docs[:limit]]
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for doc in await self.to_list():
+            yield doc
+
+
+class FakeCollection:
+    # In-memory subset of motor's AsyncIOMotorCollection API used by this app
+    def __init__(self, latency: float = 0.002, name: str = ""):
+        self.latency = latency
+        self.name = name
+        self._docs = {}
+        self._unique = {}  # field -> {value: _id}
+        self.operations = 0
+
+    async def _delay(self):
+        self.operations += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    def _check_unique(self, doc: dict, ignore_id=None):
+        for field, index in self._unique.items():
+            if field in doc and index.get(doc[field], ignore_id) != ignore_id:
+                raise DuplicateKeyError(f"E11000 duplicate key error: {field}")
+
+    def _store(self, doc: dict, previous: Optional[dict] = None):
+        for field, index in self._unique.items():
+            if previous is not None and field in previous:
+                index.pop(previous[field], None)
+            if field in doc:
+                index[doc[field]] = doc["_id"]
+        self._docs[doc["_id"]] = doc
+
+    def _insert(self, doc: dict):
+        doc = deepcopy(doc)
+        doc.setdefault("_id", ObjectId())
+        if doc["_id"] in self._docs:
+            raise DuplicateKeyError("E11000 duplicate key error: _id")
+        self._check_unique(doc)
+        self._store(doc)
+        return doc["_id"]
+
+    def _candidates(self, query: Optional[dict]):
+        # Equality on _id or a unique field is answered from the index, like a real point lookup
+        if query and "_id" in query and not isinstance(query["_id"], dict):
+            doc = self._docs.get(query["_id"])
+            return [doc] if doc is not None else []
+        for field, index in self._unique.items():
+            if query and field in query and not isinstance(query[field], dict):
+                _id = index.get(query[field])
+                return [self._docs[_id]] if _id is not None else []
+        return list(self._docs.values())
+
+    def _remove(self, _id):
+        doc = self._docs.pop(_id)
+        for field, index in self._unique.items():
+            if field in doc:
+                index.pop(doc[field], None)
+
+    def _apply(self, doc: dict, update: dict, inserting: bool):
+        for op, fields in update.items():
+            if op == "$set" or (op == "$setOnInsert" and inserting):
+                doc.update(deepcopy(fields))
+            elif op == "$inc":
+                for field, amount in fields.items():
+                    doc[field] = doc.get(field, 0) + amount
+            elif op == "$unset":
+                for field in fields:
+                    doc.pop(field, None)
+            elif op == "$push":
+                for field, value in fields.items():
+                    items = doc.setdefault(field, [])
+                    if isinstance(value, dict) and "$each" in value:
+                        items.extend(deepcopy(value["$each"]))
+                        if "$slice" in value:
+                            doc[field] = items[value["$slice"]:] if value["$slice"] < 0 else items[:value["$slice"]]
+                    else:
+                        items.append(deepcopy(value))
+            elif op != "$setOnInsert":
+                raise NotImplementedError(f"Fake Mongo does not support {op}")
+
+    def _update(self, query: dict, update: dict, upsert: bool, many: bool = False):
+        matched = [d for d in self._candidates(query) if _matches(d, query)]
+        if not many:
+            matched = matched[:1]
+        for doc in matched:
+            updated = deepcopy(doc)
+            self._apply(updated, update, inserting=False)
+            self._check_unique(updated, ignore_id=doc["_id"])
+            self._store(updated, previous=doc)
+        if matched or not upsert:
+            return matched, None
+        doc = {k: v for k, v in query.items() if not k.startswith("$") and not isinstance(v, dict)}
+        self._apply(doc, update, inserting=True)
+        return [], self._insert(doc)
+
+    async def create_index(self, keys, unique: bool = False, **kwargs):
+        await self._delay()
+        if unique and isinstance(keys, str) and keys not in self._unique:
+            self._unique[keys] = {d[keys]: _id for _id, d in self._docs.items() if keys in d}
+        return keys if isinstance(keys, str) else "_".join(f"{k}_{d}" for k, d in keys)
+
+    async def find_one(self, query: Optional[dict] = None, projection: Optional[dict] = None, **kwargs):
+        await self._delay()
+        for doc in self._candidates(query):
+            if _matches(doc, query):
+                return _project(doc, projection)
+        return None
+
+    def find(self, query: Optional[dict] = None, projection: Optional[dict] = None, **kwargs):
+        return FakeCursor(self, query, projection)
+
+    async def count_documents(self, query: dict):
+        await self._delay()
+        return sum(1 for d in self._docs.values() if _matches(d, query))
+
+    async def insert_one(self, doc: dict):
+        await self._delay()
+        inserted_id = self._insert(doc)
+        doc.setdefault("_id", inserted_id)
+        return _Result(inserted_id=inserted_id)
+
+    async def update_one(self, query: dict, update: dict, upsert: bool = False, **kwargs):
+        await self._delay()
+        matched, upserted_id = self._update(query, update, upsert)
+        return _Result(matched_count=len(matched), modified_count=len(matched), upserted_id=upserted_id)
+
+    async def update_many(self, query: dict, update: dict, upsert: bool = False, **kwargs):
+        await self._delay()
+        matched, upserted_id = self._update(query, update, upsert, many=True)
+        return _Result(matched_count=len(matched), modified_count=len(matched), upserted_id=upserted_id)
+
+    async def find_one_and_update(self, query: dict, update: dict, projection: Optional[dict] = None,
+                                  upsert: bool = False, return_document: bool = False, sort=None, **kwargs):
+        await self._delay()
+        if sort:
+            candidates = await FakeCursor(self, query, None).sort(sort).limit(1).to_list()
+            if candidates:
+                query = {"_id": candidates[0]["_id"]}
+        before = next((deepcopy(d) for d in self._candidates(query) if _matches(d, query)), None)
+        matched, upserted_id = self._update(query, update, upsert)
+        if return_document:
+            _id = matched[0]["_id"] if matched else upserted_id
+            return _project(self._docs[_id], projection) if _id is not None else None
+        return _project(before, projection) if before else None
+
+    async def delete_one(self, query: dict):
+        await self._delay()
+        for _id, doc in list(self._docs.items()):
+            if _matches(doc, query):
+                self._remove(_id)
+                return _Result(deleted_count=1)
+        return _Result(deleted_count=0)
+
+    async def delete_many(self, query: dict):
+        await self._delay()
+        doomed = [_id for _id, d in self._docs.items() if _matches(d, query)]
+        for _id in doomed:
+            self._remove(_id)
+        return _Result(deleted_count=len(doomed))
+
+    async def bulk_write(self, requests, ordered: bool = True):
+        await self._delay()
+        inserted = modified = upserted = 0
+        for request in requests:
+            try:
+                if isinstance(request, InsertOne):
+                    self._insert(request._doc)
+                    inserted += 1
+                elif isinstance(request, (UpdateOne, UpdateMany)):
+                    matched, upserted_id = self._update(
+                        request._filter, request._doc, bool(request._upsert), many=isinstance(request, UpdateMany)
+                    )
+                    modified += len(matched)
+                    upserted += upserted_id is not None
+                elif isinstance(request, DeleteOne):
+                    doomed = next((_id for _id, d in self._docs.items() if _matches(d, request._filter)), None)
+                    if doomed is not None:
+                        self._remove(doomed)
+            except DuplicateKeyError:
+                if ordered:
+                    raise
+        return _Result(inserted_count=inserted, modified_count=modified, upserted_count=upserted)
+
+
+class FakeDatabase:
+    def __init__(self, latency: float = 0.002):
+        self.latency = latency
+        self._collections = {}
+
+    def __getitem__(self, name: str) -> FakeCollection:
+        if name not in self._collections:
+            self._collections[name] = FakeCollection(self.latency, name)
+        return self._collections[name]
+
+    async def command(self, name: str, *args, **kwargs):
+        await asyncio.sleep(self.latency)
+        return {"ok": 1.0}
+
+
+def fake_verify_oauth2_token(token: str, request, audience=None, **kwargs):
+    # Codes of the form "user-<n>" map to a stable Google identity
+    return {"sub": f"google-{token}", "email": f"{token}@example.com", "aud": audience}
+
+
+def fake_construct_event(payload, sig_header, secret, **kwargs):
+    # Accepts any signature; the payload is the event itself
+    return json.loads(payload)
+
+
+class FakeCheckoutSession:
+    def __init__(self, **kwargs):
+        self.id = f"cs_test_{_seed(repr(sorted(kwargs.items()))) % 10 ** 12}"
+        self.url = f"https://checkout.stripe.test/{self.id}"
+
+    @classmethod
+    def create(cls, **kwargs):
+        return cls(**kwargs)
@@ -0,0 +1,252 @@
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import logging
+import platform
+import subprocess
+from datetime import datetime, timezone
+import numpy as np
+import httpx
+
+# Offline load test for the API. Every upstream (OpenAI, Pinecone, MongoDB, Google,
+# Stripe) is replaced by a deterministic fake from bench.fakes, so runs are free
+# and repeatable. Run from the repository root:
+#
+#   python -m bench.run --scenarios query auth_callback --concurrency 1 8 32 128 --output run.json
+#   python -m bench.run --baseline run.json        # compare a new run against an earlier one
+
+# Keep the app away from real services before any of its modules are imported
+os.environ.setdefault("OPENAI_API_KEY", "bench")
+os.environ.setdefault("PINECONE_API_KEY", "bench")
+os.environ["EMBEDDING_CACHE_DIR"] = ""
+os.environ["ANSWER_CACHE_SHARED"] = "false"
+os.environ["CHAT_HISTORY_PERSIST"] = "false"
+
+from bench.fakes import (  # noqa: E402
+    FakeDatabase, FakeEmbeddings, FakeVectorStore, FakeLLM, FakeCheckoutSession,
+    fake_verify_oauth2_token, fake_construct_event,
+)
+
+logger = logging.getLogger("bench")
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def install_fakes(args):
+    import database
+    import query
+    import auth
+    import payment
+    import main
+    import ratelimit
+    from embedding_cache import CachedEmbeddings
+
+    fake_db = FakeDatabase(latency=args.mongo_latency)
+    database.client = fake_db
+    database.db = fake_db
+    database.users_collection = fake_db["users"]
+    database.quota_collection = fake_db["query_quota"]
+    database.answer_cache_collection = fake_db["answer_cache"]
+    database.chat_history_collection = fake_db["chat_history"]
+    database.stripe_events_collection = fake_db["stripe_events"]
+    database.session_revocations_collection = fake_db["session_revocations"]
+    database.jobs_collection = fake_db["jobs"]
+    users = fake_db["users"]
+    await users.create_index("google_user_id", unique=True)
+    await users.create_index("email", unique=True)
+    for i in range(args.users):
+        await users.insert_one({
+            "google_user_id": f"g{i}", "email": f"user{i}@example.com", "is_subscriber": True,
+        })
+
+    fakes = {
+        "embeddings": FakeEmbeddings(dim=args.embedding_dim, latency=args.embedding_latency),
+        "vectorstore": FakeVectorStore(latency=args.retrieval_latency, dim=args.embedding_dim),
+        "llm": FakeLLM(latency=args.llm_latency, token_latency=args.llm_token_latency, tokens=args.llm_tokens),
+        "mongo": fake_db,
+    }
+    query.embeddings = CachedEmbeddings(fakes["embeddings"], path=None)
+    query.vectorstore = fakes["vectorstore"]
+    query.chat_model = fakes["llm"]
+    query.retrieval_chain = query.build_retrieval_chain(fakes["llm"])
+    query.ANSWER_CACHE_ENABLED = args.answer_cache
+
+    # Quota is not what is being measured; let every seeded user query freely
+    main.query_limit = lambda is_subscriber: 10 ** 9
+    # Neither is rate limiting: every bench request comes from one client
+    ratelimit.RATE_LIMIT_ENABLED = False
+    auth.id_token.verify_oauth2_token = fake_verify_oauth2_token
+    payment.stripe.Webhook.construct_event = fake_construct_event
+    payment.stripe.checkout.Session = FakeCheckoutSession
+    return main.app, fakes
+
+
+def _upstream_calls(fakes):
+    return {
+        "embedding_calls": fakes["embeddings"].calls,
+        "retrieval_calls": fakes["vectorstore"].calls,
+        "llm_calls": fakes["llm"].calls,
+        "mongo_operations": sum(c.operations for c in fakes["mongo"]._collections.values()),
+    }
+
+
+def build_scenarios(args):
+    def user(i):
+        return f"user{i % args.users}@example.com"
+
+    return {
+        # Every question is new: full pipeline per request
+        "query": lambda i: ("POST", "/query", {"params": {
+            "query": f"What is the pathophysiology of condition {i}?", "user_email": user(i)}}),
+        # A small pool of popular questions: exercises caching and coalescing
+        "query_repeat": lambda i: ("POST", "/query", {"params": {
+            "query": f"What is the pathophysiology of condition {i % 20}?", "user_email": user(i)}}),
+        "query_stream": lambda i: ("POST", "/query/stream", {"params": {
+            "query": f"What is the pathophysiology of condition {i}?", "user_email": user(i)}}),
+        "auth_callback": lambda i: ("GET", "/auth/auth/callback", {"params": {"code": f"user-{i}"}}),
+        "checkout": lambda i: ("POST", "/payment/create-checkout-session", {"params": {"user_email": user(i)}}),
+        "stripe_webhook": lambda i: ("POST", "/payment/stripe-webhook", {
+            "content": json.dumps({
+                "id": f"evt_{i}",
+                "type": "checkout.session.completed",
+                "data": {"object": {"client_reference_id": f"g{i % args.users}"}},
+            }),
+            "headers": {"Stripe-Signature": "bench"},
+        }),
+    }
+
+
+async def run_level(client, build, concurrency: int, requests: int, offset: int):
+    latencies = []
+    status_codes = {}
+    indexes = iter(range(offset, offset + requests))
+
+    async def worker():
+        for i in indexes:
+            method, url, kwargs = build(i)
+            started = time.perf_counter()
+            try:
+                response = await client.request(method, url, **kwargs)
+                code = str(response.status_code)
+            except Exception as e:
+                logger.error(f"Request failed: {e}")
+                code = "exception"
+            latencies.append((time.perf_counter() - started) * 1000)
+            status_codes[code] = status_codes.get(code, 0) + 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    samples = np.asarray(latencies)
+    return {
+        "concurrency": concurrency,
+        "requests": requests,
+        "elapsed_s": round(elapsed, 3),
+        "throughput_rps": round(requests / elapsed, 2),
+        "mean_ms": round(float(samples.mean()), 2),
+        "p50_ms": round(float(np.percentile(samples, 50)), 2),
+        "p95_ms": round(float(np.percentile(samples, 95)), 2),
+        "p99_ms": round(float(np.percentile(samples, 99)), 2),
+        "max_ms": round(float(samples.max()), 2),
+        "status_codes": status_codes,
+        "errors": sum(n for code, n in status_codes.items() if not code.startswith("2")),
+    }
+
+
+async def run(args):
+    app, fakes = await install_fakes(args)
+    scenarios = build_scenarios(args)
+    results = {}
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+        offset = 0
+        for name in args.scenarios:
+            results[name] = []
+            for concurrency in args.concurrency:
+                requests = max(args.requests, concurrency)
+                before = _upstream_calls(fakes)
+                level = await run_level(client, scenarios[name], concurrency, requests, offset)
+                after = _upstream_calls(fakes)
+                level["upstream"] = {key: after[key] - before[key] for key in after}
+                results[name].append(level)
+                offset += requests
+                logger.info(
+                    f"{name} c={concurrency}: {level['throughput_rps']} req/s, "
+                    f"p50 {level['p50_ms']} ms, p95 {level['p95_ms']} ms, p99 {level['p99_ms']} ms, "
+                    f"errors {level['errors']}"
+                )
+    return {
+        "run": {
+            "started_at": datetime.now(timezone.utc).isoformat(),
+            "git_commit": _git_commit(),
+            "python": platform.python_version(),
+            "config": {k: v for k, v in vars(args).items() if k not in ("output", "baseline")},
+        },
+        "results": results,
+    }
+
+
+def compare(report, baseline):
+    # Relative change per scenario and concurrency; positive p95 deltas are regressions
+    rows = []
+    for name, levels in report["results"].items():
+        previous = {level["concurrency"]: level for level in baseline.get("results", {}).get(name, [])}
+        for level in levels:
+            old = previous.get(level["concurrency"])
+            if not old:
+                continue
+            rows.append({
+                "scenario": name,
+                "concurrency": level["concurrency"],
+                "throughput_change_pct": round((level["throughput_rps"] / old["throughput_rps"] - 1) * 100, 1),
+                "p95_change_pct": round((level["p95_ms"] / old["p95_ms"] - 1) * 100, 1),
+                "p99_change_pct": round((level["p99_ms"] / old["p99_ms"] - 1) * 100, 1),
+            })
+    return rows
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Offline load test with local stand-ins for every upstream")
+    parser.add_argument("--scenarios", nargs="+", default=["query", "query_repeat", "auth_callback", "stripe_webhook"],
+                        choices=["query", "query_repeat", "query_stream", "auth_callback", "checkout", "stripe_webhook"])
+    parser.add_argument("--concurrency", nargs="+", type=int, default=[1, 8, 32, 128])
+    parser.add_argument("--requests", type=int, default=200, help="requests per concurrency level")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--answer-cache", action="store_true", help="leave the semantic answer cache enabled")
+    parser.add_argument("--embedding-dim", type=int, default=1536)
+    parser.add_argument("--embedding-latency", type=float, default=0.05)
+    parser.add_argument("--retrieval-latency", type=float, default=0.08)
+    parser.add_argument("--llm-latency", type=float, default=0.5, help="seconds to first token")
+    parser.add_argument("--llm-token-latency", type=float, default=0.005)
+    parser.add_argument("--llm-tokens", type=int, default=200)
+    parser.add_argument("--mongo-latency", type=float, default=0.002)
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    parser.add_argument("--baseline", help="earlier JSON report to compare against")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    logging.basicConfig(level=logging.INFO)
+    # Per-request app logging would dominate the measurements
+    for name in ("main", "query", "auth", "payment", "database", "httpx"):
+        logging.getLogger(name).setLevel(logging.WARNING)
+    report = asyncio.run(run(args))
+    if args.baseline:
+        with open(args.baseline) as f:
+            report["comparison"] = compare(report, json.load(f))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        logger.info(f"Report written to {args.output}")
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
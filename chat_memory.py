@@ -0,0 +1,170 @@
+import os
+import time
+import asyncio
+import logging
+import threading
+from collections import OrderedDict, deque
+from datetime import datetime, timezone
+from pymongo import UpdateOne, errors
+from tokens import count_tokens
+
+logger = logging.getLogger(__name__)
+
+# Configuration for per-user conversation history
+CHAT_HISTORY_TOKEN_BUDGET = int(os.getenv("CHAT_HISTORY_TOKEN_BUDGET", "1500"))
+CHAT_HISTORY_MAX_TURNS = int(os.getenv("CHAT_HISTORY_MAX_TURNS", "10"))
+CHAT_HISTORY_MAX_SESSIONS = int(os.getenv("CHAT_HISTORY_MAX_SESSIONS", "10000"))
+CHAT_HISTORY_IDLE_TTL = int(os.getenv("CHAT_HISTORY_IDLE_TTL", "3600"))
+CHAT_HISTORY_PERSIST = os.getenv("CHAT_HISTORY_PERSIST", "false").lower() == "true"
+CHAT_HISTORY_FLUSH_INTERVAL = float(os.getenv("CHAT_HISTORY_FLUSH_INTERVAL", "2.0"))
+CHAT_HISTORY_RETENTION = int(os.getenv("CHAT_HISTORY_RETENTION", "604800"))
+
+
+class _Session:
+    __slots__ = ("turns", "tokens", "last_used", "version")
+
+    def __init__(self):
+        self.turns = deque()  # (question, answer, tokens)
+        self.tokens = 0
+        self.last_used = time.monotonic()
+        self.version = 0  # turns ever pushed to Mongo, as last seen by this worker
+
+
+class ConversationStore:
+    # Chat history per session (the user's google_user_id). Each session keeps its
+    # newest turns within a token budget; idle sessions are evicted LRU-first once
+    # they pass the TTL or the store is full. With a collection configured, new turns
+    # are appended to Mongo write-behind, and a session is reloaded whenever another
+    # worker has appended to it since this one last saw it.
+    def __init__(self, token_budget: int = CHAT_HISTORY_TOKEN_BUDGET, max_turns: int = CHAT_HISTORY_MAX_TURNS,
+                 max_sessions: int = CHAT_HISTORY_MAX_SESSIONS, idle_ttl: int = CHAT_HISTORY_IDLE_TTL,
+                 collection=None):
+        self.token_budget = token_budget
+        self.max_turns = max_turns
+        self.max_sessions = max_sessions
+        self.idle_ttl = idle_ttl
+        self.collection = collection
+        self._sessions = OrderedDict()
+        self._dirty = {}
+        self._lock = threading.Lock()
+
+    def _evict(self, now: float):
+        while self._sessions:
+            session_id, session = next(iter(self._sessions.items()))
+            if len(self._sessions) <= self.max_sessions and now - session.last_used < self.idle_ttl:
+                break
+            del self._sessions[session_id]
+
+    def _append(self, session: _Session, question: str, answer: str, tokens: int):
+        session.turns.append((question, answer, tokens))
+        session.tokens += tokens
+        while session.turns and (session.tokens > self.token_budget or len(session.turns) > self.max_turns):
+            session.tokens -= session.turns.popleft()[2]
+
+    def turns(self, session_id: str):
+        # Oldest first, as (question, answer, tokens)
+        if not session_id:
+            return []
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None:
+                return []
+            session.last_used = time.monotonic()
+            self._sessions.move_to_end(session_id)
+            return list(session.turns)
+
+    def save(self, session_id: str, question: str, answer: str):
+        if not session_id:
+            return
+        tokens = count_tokens(question) + count_tokens(answer)
+        now = time.monotonic()
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None:
+                session = self._sessions[session_id] = _Session()
+            session.last_used = now
+            self._sessions.move_to_end(session_id)
+            self._append(session, question, answer, tokens)
+            if self.collection is not None:
+                self._dirty.setdefault(session_id, []).append({"question": question, "answer": answer, "tokens": tokens})
+            self._evict(now)
+
+    async def aload(self, session_id: str):
+        # Loads the session from Mongo when it is cold here or another worker has
+        # appended to it since, so history survives restarts and is shared across workers
+        if not session_id or self.collection is None:
+            return
+        with self._lock:
+            session = self._sessions.get(session_id)
+            version = None if session is None else session.version
+        query = {"_id": session_id}
+        if version is not None:
+            query["version"] = {"$gt": version}
+        try:
+            doc = await self.collection.find_one(query, {"_id": 0, "turns": 1, "version": 1})
+        except errors.PyMongoError as e:
+            logger.error(f"Error loading chat history for {session_id}: {e}")
+            return
+        if doc is None and version is not None:
+            return
+        with self._lock:
+            current = self._sessions.get(session_id)
+            if current is not None and current.version != version:
+                return  # reloaded concurrently
+            session = _Session()
+            if doc is not None:
+                session.version = doc.get("version", 0)
+                for turn in doc.get("turns", []):
+                    self._append(session, turn["question"], turn["answer"], turn["tokens"])
+            # Turns saved here but not yet flushed go after the stored ones
+            for turn in self._dirty.get(session_id, []):
+                self._append(session, turn["question"], turn["answer"], turn["tokens"])
+            self._sessions[session_id] = session
+            self._sessions.move_to_end(session_id)
+            self._evict(session.last_used)
+
+    async def flush(self):
+        with self._lock:
+            dirty, self._dirty = self._dirty, {}
+            seen = {sid: self._sessions[sid].version for sid in dirty if sid in self._sessions}
+        if not dirty or self.collection is None:
+            return
+        now = datetime.now(timezone.utc)
+        # Appends rather than overwrites, so turns written by other workers are kept
+        operations = [
+            UpdateOne(
+                {"_id": session_id},
+                {
+                    "$push": {"turns": {"$each": turns, "$slice": -self.max_turns}},
+                    "$inc": {"version": len(turns)},
+                    "$set": {"updated_at": now},
+                },
+                upsert=True,
+            )
+            for session_id, turns in dirty.items()
+        ]
+        try:
+            await self.collection.bulk_write(operations, ordered=False)
+        except errors.PyMongoError as e:
+            logger.error(f"Error writing chat history: {e}")
+            with self._lock:
+                for session_id, turns in dirty.items():
+                    self._dirty[session_id] = turns + self._dirty.get(session_id, [])
+            return
+        with self._lock:
+            # Our own appends are already in memory; anything beyond them triggers a
+            # reload. A session reloaded meanwhile already carries the newer version.
+            for session_id, turns in dirty.items():
+                session = self._sessions.get(session_id)
+                if session is not None and session.version == seen.get(session_id):
+                    session.version += len(turns)
+
+    async def run_write_behind(self, interval: float = CHAT_HISTORY_FLUSH_INTERVAL):
+        while True:
+            await asyncio.sleep(interval)
+            await self.flush()
+
+    async def ensure_indexes(self):
+        if self.collection is None:
+            return
+        await self.collection.create_index("updated_at", expireAfterSeconds=CHAT_HISTORY_RETENTION)
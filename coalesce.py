@@ -0,0 +1,77 @@
+import os
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Configuration for request coalescing and micro-batching
+COALESCE_ENABLED = os.getenv("COALESCE_ENABLED", "true").lower() == "true"
+COALESCE_MAX_BATCH_SIZE = int(os.getenv("COALESCE_MAX_BATCH_SIZE", "16"))
+COALESCE_MAX_WAIT_MS = float(os.getenv("COALESCE_MAX_WAIT_MS", "5"))
+
+
+class SingleFlight:
+    # Concurrent calls with the same key share one execution of the first caller's
+    # coroutine. The shared task is shielded, so one caller going away does not
+    # cancel the work the others are waiting on.
+    def __init__(self):
+        self._inflight = {}
+        self.shared = 0
+
+    async def do(self, key, factory):
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(factory())
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        else:
+            self.shared += 1
+        return await asyncio.shield(task)
+
+
+class MicroBatcher:
+    # Collects items submitted within `max_wait_ms` of each other (or until
+    # `max_batch_size` is reached) and hands them to `handler` as one list. The
+    # handler returns one result per item, in order.
+    def __init__(self, handler, max_batch_size: int = COALESCE_MAX_BATCH_SIZE,
+                 max_wait_ms: float = COALESCE_MAX_WAIT_MS, name: str = "batch"):
+        self.handler = handler
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.name = name
+        self.batches = 0
+        self.items = 0
+        self._pending = []
+        self._timer = None
+
+    async def submit(self, item):
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((item, future))
+        if len(self._pending) >= self.max_batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.max_wait, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            asyncio.ensure_future(self._run(batch))
+
+    async def _run(self, batch):
+        self.batches += 1
+        self.items += len(batch)
+        try:
+            results = await self.handler([item for item, _ in batch])
+        except Exception as e:
+            logger.error(f"Error in {self.name} batch of {len(batch)}: {e}")
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
@@ -1,19 +1,88 @@
-from pydantic import BaseModel, EmailStr
-from typing import Optional
-from pymongo import MongoClient, errors
+import os
 import logging
+from datetime import datetime, time, timedelta, timezone
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument, UpdateOne, UpdateMany, errors
 
-# Initialize MongoDB connection and logging
-client = MongoClient("mongodb://localhost:27017")
-db = client["mydatabase"]
-users_collection = db["users"]
 logger = logging.getLogger(__name__)
 
+# MongoDB configuration: one connection pool per worker process, shared by every router
+MONGO_URI = os.getenv("MONGO_URI", "mongodb://localhost:27017")
+MONGO_DB_NAME = os.getenv("MONGO_DB_NAME", "mydatabase")
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", "100"))
+MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", "0"))
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.getenv("MONGO_SERVER_SELECTION_TIMEOUT_MS", "5000"))
+MONGO_CONNECT_TIMEOUT_MS = int(os.getenv("MONGO_CONNECT_TIMEOUT_MS", "5000"))
+MONGO_SOCKET_TIMEOUT_MS = int(os.getenv("MONGO_SOCKET_TIMEOUT_MS", "10000"))
+MONGO_READ_PREFERENCE = os.getenv("MONGO_READ_PREFERENCE", "primary")
+
+client = AsyncIOMotorClient(
+    MONGO_URI,
+    maxPoolSize=MONGO_MAX_POOL_SIZE,
+    minPoolSize=MONGO_MIN_POOL_SIZE,
+    serverSelectionTimeoutMS=MONGO_SERVER_SELECTION_TIMEOUT_MS,
+    connectTimeoutMS=MONGO_CONNECT_TIMEOUT_MS,
+    socketTimeoutMS=MONGO_SOCKET_TIMEOUT_MS,
+    readPreference=MONGO_READ_PREFERENCE,
+)
+db = client[MONGO_DB_NAME]
+users_collection = db["users"]
+quota_collection = db["query_quota"]
+answer_cache_collection = db["answer_cache"]
+chat_history_collection = db["chat_history"]
+stripe_events_collection = db["stripe_events"]
+session_revocations_collection = db["session_revocations"]
+jobs_collection = db["jobs"]
+
+# Fields returned by default; hot-path callers can ask for less
+USER_FIELDS = {"_id": 0, "google_user_id": 1, "email": 1, "is_subscriber": 1}
+
+# Counter documents outlive their day by this much before the TTL monitor removes them
+QUOTA_RETENTION = timedelta(days=int(os.getenv("QUOTA_RETENTION_DAYS", "2")))
+
+# How long verified Stripe events stay in the log and can be replayed
+STRIPE_EVENT_RETENTION_DAYS = int(os.getenv("STRIPE_EVENT_RETENTION_DAYS", "90"))
+
+
+async def ping():
+    await client.admin.command("ping")
+
+
+def _indexes():
+    return [
+        (users_collection, "google_user_id", {"unique": True}),
+        (users_collection, "email", {"unique": True}),
+        (quota_collection, "expires_at", {"expireAfterSeconds": 0}),
+        (users_collection, "stripe_customer_id", {"sparse": True}),
+        (stripe_events_collection, [("status", 1), ("created", 1)], {}),
+        (stripe_events_collection, "received_at", {"expireAfterSeconds": STRIPE_EVENT_RETENTION_DAYS * 86400}),
+        (session_revocations_collection, "revoked_at", {}),
+        (session_revocations_collection, "expires_at", {"expireAfterSeconds": 0}),
+        (jobs_collection, [("status", 1), ("priority", -1), ("created_at", 1)], {}),
+        (jobs_collection, "expires_at", {"expireAfterSeconds": 0}),
+    ]
+
+
+async def ensure_indexes():
+    # Each index is built on its own so one failure (e.g. duplicate emails blocking
+    # the unique index) does not skip the rest; any failure fails the readiness check
+    failed = []
+    for collection, keys, options in _indexes():
+        try:
+            await collection.create_index(keys, **options)
+        except errors.PyMongoError as e:
+            logger.error(f"Error creating index {keys} on {collection.name}: {e}")
+            failed.append(f"{collection.name}.{keys}")
+    if failed:
+        raise RuntimeError(f"Failed to create MongoDB indexes: {', '.join(failed)}")
+    logger.info("MongoDB indexes ensured")
+
+
 class User:
     @staticmethod
-    def get_user_by_google_id(google_user_id: str):
+    async def get_user_by_google_id(google_user_id: str, fields: dict = USER_FIELDS):
         try:
-            user = users_collection.find_one({"google_user_id": google_user_id})
+            user = await users_collection.find_one({"google_user_id": google_user_id}, fields)
             logger.info(f"Retrieved user for Google ID {google_user_id}")
             return user
         except errors.PyMongoError as e:
@@ -21,36 +90,57 @@ class User:
             return None
 
     @staticmethod
-    def create_user(google_user_id: str, email: str):
+    async def get_user_by_email(email: str, fields: dict = USER_FIELDS):
+        try:
+            return await users_collection.find_one({"email": email}, fields)
+        except errors.PyMongoError as e:
+            logger.error(f"Error retrieving user by email: {e}")
+            return None
+
+    @staticmethod
+    async def create_user(google_user_id: str, email: str):
         user_data = {
             "google_user_id": google_user_id,
             "email": email,
-            "is_subscriber": False,
-            "query_count": 0
+            "is_subscriber": False
         }
         try:
-            users_collection.insert_one(user_data)
+            # insert_one adds an ObjectId _id to the document it is given
+            await users_collection.insert_one(dict(user_data))
             logger.info(f"Created new user with Google ID {google_user_id}")
             return user_data
+        except errors.DuplicateKeyError:
+            return await User.get_user_by_google_id(google_user_id)
         except errors.PyMongoError as e:
             logger.error(f"Error creating user with Google ID {google_user_id}: {e}")
             return None
 
     @staticmethod
-    def update_user_query_count(google_user_id: str, query_count: int):
-        try:
-            users_collection.update_one(
-                {"google_user_id": google_user_id},
-                {"$set": {"query_count": query_count}}
-            )
-            logger.info(f"Updated query count for Google ID {google_user_id}")
-        except errors.PyMongoError as e:
-            logger.error(f"Error updating query count for Google ID {google_user_id}: {e}")
+    async def get_or_create_user(google_user_id: str, email: str):
+        user = await User.get_user_by_google_id(google_user_id)
+        return user or await User.create_user(google_user_id, email)
+
+    @staticmethod
+    async def bulk_update(operations: list):
+        # Errors propagate so the caller can retry the whole batch
+        await users_collection.bulk_write(operations, ordered=True)
+
+    @staticmethod
+    async def get_subscriber_flags(google_user_ids, customer_ids) -> dict:
+        # google_user_id -> is_subscriber for users matched by either id
+        cursor = users_collection.find(
+            {"$or": [
+                {"google_user_id": {"$in": list(google_user_ids)}},
+                {"stripe_customer_id": {"$in": list(customer_ids)}},
+            ]},
+            {"_id": 0, "google_user_id": 1, "is_subscriber": 1},
+        )
+        return {user["google_user_id"]: bool(user.get("is_subscriber")) for user in await cursor.to_list(None)}
 
     @staticmethod
-    def update_subscription_status(google_user_id: str, is_subscriber: bool):
+    async def update_subscription_status(google_user_id: str, is_subscriber: bool):
         try:
-            users_collection.update_one(
+            await users_collection.update_one(
                 {"google_user_id": google_user_id},
                 {"$set": {"is_subscriber": is_subscriber}}
             )
@@ -58,14 +148,140 @@ class User:
         except errors.PyMongoError as e:
             logger.error(f"Error updating subscription status for Google ID {google_user_id}: {e}")
 
-class UserCreateModel(BaseModel):
-    google_user_id: str
-    email: EmailStr
-    is_subscriber: Optional[bool] = False
-    query_count: Optional[int] = 0
-
-class UserResponseModel(BaseModel):
-    google_user_id: str
-    email: EmailStr
-    is_subscriber: bool
-    query_count: int
+
+class QueryQuota:
+    @staticmethod
+    async def reserve(google_user_id: str, limit: int):
+        # One conditional upsert on the user's counter for today (UTC). When the
+        # counter is already at the limit the filter misses and the upsert collides
+        # with the existing _id. Two first requests of the day can also collide, so
+        # a collision is retried once as a plain update. Returns the bucket id to
+        # refund with, or None when the limit is reached.
+        day = datetime.now(timezone.utc).date()
+        bucket_id = f"{google_user_id}:{day.isoformat()}"
+        expires_at = datetime.combine(day + timedelta(days=1), time.min, tzinfo=timezone.utc) + QUOTA_RETENTION
+        query = {"_id": bucket_id, "count": {"$lt": limit}}
+        try:
+            await quota_collection.find_one_and_update(
+                query,
+                {
+                    "$inc": {"count": 1},
+                    "$setOnInsert": {"google_user_id": google_user_id, "day": day.isoformat(), "expires_at": expires_at},
+                },
+                projection={"_id": 1},
+                upsert=True,
+                return_document=ReturnDocument.AFTER,
+            )
+        except errors.DuplicateKeyError:
+            reserved = await quota_collection.find_one_and_update(
+                query, {"$inc": {"count": 1}}, projection={"_id": 1}, return_document=ReturnDocument.AFTER,
+            )
+            if reserved is None:
+                return None
+        return bucket_id
+
+    @staticmethod
+    async def refund(bucket_id: str):
+        try:
+            await quota_collection.update_one({"_id": bucket_id, "count": {"$gt": 0}}, {"$inc": {"count": -1}})
+            logger.info(f"Refunded query reservation {bucket_id}")
+        except errors.PyMongoError as e:
+            logger.error(f"Error refunding query reservation {bucket_id}: {e}")
+
+
+class StripeEvents:
+    # Event log behind the Stripe webhook. _id is the Stripe event id, so a
+    # redelivered event collides with the stored one and is not applied twice.
+    @staticmethod
+    async def record(event: dict):
+        # Returns False for a duplicate delivery; other Mongo errors propagate so
+        # the webhook answers 500 and Stripe retries
+        try:
+            await stripe_events_collection.insert_one({
+                "_id": event["id"],
+                "type": event["type"],
+                "created": event.get("created") or int(datetime.now(timezone.utc).timestamp()),
+                "object": event["data"]["object"],
+                "status": "pending",
+                "received_at": datetime.now(timezone.utc),
+            })
+        except errors.DuplicateKeyError:
+            logger.info(f"Stripe event {event['id']} already recorded")
+            return False
+        return True
+
+    @staticmethod
+    async def pending(limit: int):
+        cursor = stripe_events_collection.find({"status": "pending"}).sort([("created", 1)]).limit(limit)
+        return await cursor.to_list(limit)
+
+    @staticmethod
+    async def mark(processed_ids: list, ignored_ids: list):
+        # Called once the events' user changes are written
+        now = datetime.now(timezone.utc)
+        marks = [
+            UpdateMany({"_id": {"$in": ids}}, {"$set": {"status": status, "processed_at": now}})
+            for status, ids in (("processed", processed_ids), ("ignored", ignored_ids)) if ids
+        ]
+        if marks:
+            await stripe_events_collection.bulk_write(marks, ordered=False)
+
+    @staticmethod
+    async def replay(since: datetime = None, types: list = None):
+        # Puts already handled events back in the queue; returns how many were reset
+        query = {"status": {"$ne": "pending"}}
+        if since is not None:
+            query["created"] = {"$gte": int(since.timestamp())}
+        if types:
+            query["type"] = {"$in": list(types)}
+        result = await stripe_events_collection.update_many(query, {"$set": {"status": "pending"}})
+        logger.info(f"Queued {result.modified_count} Stripe events for replay")
+        return result.modified_count
+
+
+class SessionRevocations:
+    # Session tokens issued before a user's revoked_at are rejected. Entries
+    # expire once every token they could reject has expired on its own.
+    @staticmethod
+    async def revoke(google_user_ids: list, revoked_at: float, expires_at: datetime):
+        operations = [
+            UpdateOne({"_id": gid}, {"$set": {"revoked_at": revoked_at, "expires_at": expires_at}}, upsert=True)
+            for gid in google_user_ids
+        ]
+        if operations:
+            await session_revocations_collection.bulk_write(operations, ordered=False)
+
+    @staticmethod
+    async def since(revoked_at: float):
+        cursor = session_revocations_collection.find({"revoked_at": {"$gt": revoked_at}}, {"revoked_at": 1})
+        return await cursor.to_list(None)
+
+
+class Jobs:
+    # Shared queue for background queries; workers claim the highest-priority,
+    # oldest queued job, or one whose lease ran out because its worker died
+    @staticmethod
+    async def create(job: dict):
+        await jobs_collection.insert_one(job)
+
+    @staticmethod
+    async def get(job_id: str):
+        return await jobs_collection.find_one({"_id": job_id})
+
+    @staticmethod
+    async def queued_count():
+        return await jobs_collection.count_documents({"status": "queued"})
+
+    @staticmethod
+    async def claim(worker_id: str, lease: timedelta):
+        now = datetime.now(timezone.utc)
+        return await jobs_collection.find_one_and_update(
+            {"$or": [{"status": "queued"}, {"status": "running", "lease_until": {"$lt": now}}]},
+            {"$set": {"status": "running", "worker": worker_id, "started_at": now, "lease_until": now + lease}},
+            sort=[("priority", -1), ("created_at", 1)],
+            return_document=ReturnDocument.AFTER,
+        )
+
+    @staticmethod
+    async def finish(job_id: str, fields: dict):
+        await jobs_collection.update_one({"_id": job_id}, {"$set": fields})
@@ -0,0 +1,287 @@
+import os
+import re
+import asyncio
+import json
+import fcntl
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from typing import List
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+logger = logging.getLogger(__name__)
+
+# Configuration for the query embedding cache
+EMBEDDING_CACHE_DIR = os.getenv("EMBEDDING_CACHE_DIR", ".cache/embeddings")
+EMBEDDING_CACHE_MEMORY_ENTRIES = int(os.getenv("EMBEDDING_CACHE_MEMORY_ENTRIES", "10000"))
+
+_PUNCTUATION = re.compile(r"[^\w\s]")
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_text(text: str) -> str:
+    # "DKA pathophysiology?" and "dka  pathophysiology" share one cache entry
+    return _WHITESPACE.sub(" ", _PUNCTUATION.sub(" ", text.lower())).strip()
+
+
+def cache_key(text: str) -> str:
+    return hashlib.blake2b(normalize_text(text).encode("utf-8"), digest_size=16).hexdigest()
+
+
+class DiskEmbeddingStore:
+    # Append-only on-disk store shared by every worker on the host:
+    #   vectors.f32  raw float32 rows, memory-mapped for reads
+    #   keys.idx     one "<hex key> <row>" record per line
+    #   meta.json    vector dimension
+    # Writers append under an exclusive flock; readers pick up new rows lazily.
+    # The row is taken from the vector file's size and written after the vector,
+    # so a writer dying between the two appends leaves an unreferenced row, never
+    # a key pointing at another key's vector.
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self._vectors_path = os.path.join(path, "vectors.f32")
+        self._keys_path = os.path.join(path, "keys.idx")
+        self._meta_path = os.path.join(path, "meta.json")
+        self._lock_path = os.path.join(path, "lock")
+        self._index = {}
+        self._index_offset = 0
+        self._rows = 0
+        self._mmap = None
+        self.dim = None
+        self._lock = threading.Lock()
+
+    def _load_meta(self):
+        if self.dim is None and os.path.exists(self._meta_path):
+            with open(self._meta_path) as f:
+                self.dim = json.load(f)["dim"]
+
+    def _refresh_index(self):
+        if not os.path.exists(self._keys_path):
+            return
+        with open(self._keys_path, "rb") as f:
+            f.seek(self._index_offset)
+            data = f.read()
+        # Ignore a trailing partial line from a concurrent writer
+        complete = data[:data.rfind(b"\n") + 1]
+        for line in complete.splitlines():
+            parts = line.decode("ascii").split()
+            # Records without a row number predate the row field and cannot be trusted
+            if len(parts) == 2:
+                row = int(parts[1])
+                self._index[parts[0]] = row
+                self._rows = max(self._rows, row + 1)
+        self._index_offset += len(complete)
+
+    def _vector_at(self, row: int):
+        if self._mmap is None or row >= self._mmap.shape[0]:
+            self._mmap = np.memmap(self._vectors_path, dtype=np.float32, mode="r", shape=(self._rows, self.dim))
+        return self._mmap[row]
+
+    def get(self, key: str):
+        with self._lock:
+            row = self._index.get(key)
+            if row is None:
+                self._load_meta()
+                if self.dim is None:
+                    return None
+                self._refresh_index()
+                row = self._index.get(key)
+                if row is None:
+                    return None
+            return np.array(self._vector_at(row))
+
+    def get_many(self, keys):
+        return [self.get(key) for key in keys]
+
+    def put(self, key: str, vector):
+        self.put_many([(key, vector)])
+
+    def put_many(self, items):
+        items = [(key, np.asarray(vector, dtype=np.float32)) for key, vector in items]
+        if not items:
+            return
+        with self._lock, open(self._lock_path, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                self._load_meta()
+                if self.dim is None:
+                    self.dim = int(items[0][1].shape[0])
+                    with open(self._meta_path, "w") as f:
+                        json.dump({"dim": self.dim}, f)
+                self._refresh_index()
+                row_bytes = self.dim * 4
+                with open(self._vectors_path, "ab") as vectors, open(self._keys_path, "ab") as keys:
+                    # Drop a partial row left by a writer that died mid-append
+                    size = vectors.seek(0, os.SEEK_END)
+                    if size % row_bytes:
+                        vectors.truncate(size - size % row_bytes)
+                    row = size // row_bytes
+                    for key, vector in items:
+                        if key in self._index:
+                            continue
+                        if vector.shape[0] != self.dim:
+                            logger.warning(f"Embedding dimension {vector.shape[0]} does not match cache dimension {self.dim}")
+                            continue
+                        vectors.write(vector.tobytes())
+                        vectors.flush()
+                        keys.write(f"{key} {row}\n".encode("ascii"))
+                        keys.flush()
+                        self._index[key] = row
+                        row += 1
+                self._refresh_index()
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+class CachedEmbeddings(Embeddings):
+    # Wraps an Embeddings instance so repeated questions never hit the network:
+    # a bounded in-memory LRU in front of a persistent DiskEmbeddingStore.
+    def __init__(self, inner: Embeddings, path: str = EMBEDDING_CACHE_DIR,
+                 max_entries: int = EMBEDDING_CACHE_MEMORY_ENTRIES, namespace: str = None):
+        self.inner = inner
+        self.max_entries = max_entries
+        namespace = namespace or getattr(inner, "model", None) or type(inner).__name__
+        self.store = DiskEmbeddingStore(os.path.join(path, namespace)) if path else None
+        self.hits = 0
+        self.misses = 0
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get_memory(self, key: str):
+        with self._lock:
+            vector = self._memory.get(key)
+            if vector is not None:
+                self._memory.move_to_end(key)
+            return vector
+
+    def _get_disk(self, keys):
+        try:
+            vectors = self.store.get_many(keys)
+        except OSError as e:
+            logger.error(f"Error reading embedding cache: {e}")
+            return [None] * len(keys)
+        for key, vector in zip(keys, vectors):
+            if vector is not None:
+                self._remember(key, vector)
+        return vectors
+
+    def _get(self, key: str):
+        vector = self._get_memory(key)
+        if vector is None and self.store is not None:
+            vector = self._get_disk([key])[0]
+        return vector
+
+    async def _aget_many(self, keys):
+        # Memory hits stay on the event loop; the flock and file reads of disk lookups run in a thread
+        found = [self._get_memory(k) for k in keys]
+        missing = [i for i, v in enumerate(found) if v is None]
+        if missing and self.store is not None:
+            vectors = await asyncio.to_thread(self._get_disk, [keys[i] for i in missing])
+            for i, vector in zip(missing, vectors):
+                found[i] = vector
+        return found
+
+    def _remember(self, key: str, vector):
+        with self._lock:
+            self._memory[key] = vector
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_entries:
+                self._memory.popitem(last=False)
+
+    def _put_disk(self, items):
+        try:
+            self.store.put_many(items)
+        except OSError as e:
+            logger.error(f"Error writing embedding cache: {e}")
+
+    def _put(self, key: str, vector):
+        vector = np.asarray(vector, dtype=np.float32)
+        self._remember(key, vector)
+        if self.store is not None:
+            self._put_disk([(key, vector)])
+
+    async def _aput_many(self, items):
+        items = [(key, np.asarray(vector, dtype=np.float32)) for key, vector in items]
+        for key, vector in items:
+            self._remember(key, vector)
+        if self.store is not None and items:
+            await asyncio.to_thread(self._put_disk, items)
+
+    def cached(self, text: str):
+        # Cache-only lookup: returns None instead of calling the inner embedder
+        vector = self._get(cache_key(text))
+        if vector is None:
+            return None
+        self.hits += 1
+        return np.asarray(vector, dtype=np.float32).tolist()
+
+    async def acached(self, text: str):
+        vector = (await self._aget_many([cache_key(text)]))[0]
+        if vector is None:
+            return None
+        self.hits += 1
+        return np.asarray(vector, dtype=np.float32).tolist()
+
+    def _count(self, found):
+        missing = [i for i, v in enumerate(found) if v is None]
+        self.hits += len(found) - len(missing)
+        self.misses += len(missing)
+        return missing
+
+    def _split(self, texts: List[str]):
+        keys = [cache_key(t) for t in texts]
+        found = [self._get(k) for k in keys]
+        return keys, found, self._count(found)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys, found, missing = self._split(texts)
+        if missing:
+            for i, vector in zip(missing, self.inner.embed_documents([texts[i] for i in missing])):
+                self._put(keys[i], vector)
+                found[i] = vector
+        return [np.asarray(v, dtype=np.float32).tolist() for v in found]
+
+    def embed_query(self, text: str) -> List[float]:
+        key = cache_key(text)
+        vector = self._get(key)
+        if vector is None:
+            self.misses += 1
+            vector = self.inner.embed_query(text)
+            self._put(key, vector)
+        else:
+            self.hits += 1
+        return np.asarray(vector, dtype=np.float32).tolist()
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys = [cache_key(t) for t in texts]
+        found = await self._aget_many(keys)
+        missing = self._count(found)
+        if missing:
+            vectors = await self.inner.aembed_documents([texts[i] for i in missing])
+            for i, vector in zip(missing, vectors):
+                found[i] = vector
+            await self._aput_many([(keys[i], found[i]) for i in missing])
+        return [np.asarray(v, dtype=np.float32).tolist() for v in found]
+
+    async def aembed_query(self, text: str) -> List[float]:
+        key = cache_key(text)
+        vector = (await self._aget_many([key]))[0]
+        if vector is None:
+            self.misses += 1
+            vector = await self.inner.aembed_query(text)
+            await self._aput_many([(key, vector)])
+        else:
+            self.hits += 1
+        return np.asarray(vector, dtype=np.float32).tolist()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "memory_entries": len(self._memory),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
@@ -0,0 +1,181 @@
+import os
+import json
+import time
+import shutil
+import argparse
+import logging
+from datetime import datetime, timezone
+import numpy as np
+from dotenv import load_dotenv
+from local_index import (
+    LocalVectorIndex, LOCAL_INDEX_PATH, VECTORS_FILE, DOCUMENTS_FILE, OFFSETS_FILE, META_FILE,
+    IVF_CENTROIDS_FILE, IVF_ORDER_FILE, IVF_OFFSETS_FILE, normalize_rows,
+)
+
+# Snapshot tooling for the local retriever backend:
+#   python export_index.py export              pull every vector from Pinecone into a local snapshot
+#   python export_index.py build-ivf --nlist N  add IVF lists to a snapshot
+#   python export_index.py compare queries.txt  recall and latency of the snapshot against Pinecone
+
+load_dotenv()
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+PINECONE_API_KEY = os.getenv("PINECONE_API_KEY")
+OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+INDEX_NAME = os.getenv("PINECONE_INDEX_NAME", "medicalcorpus-v5")
+
+
+def _pinecone_index(index_name: str):
+    from pinecone import Pinecone as PineconeClient
+    return PineconeClient(api_key=PINECONE_API_KEY).Index(index_name)
+
+
+def export(path: str, index_name: str, namespace: str, batch_size: int, text_key: str):
+    # Writes to a temporary directory and swaps it in, so running workers never see a partial snapshot
+    index = _pinecone_index(index_name)
+    tmp_path = path + ".tmp"
+    os.makedirs(tmp_path, exist_ok=True)
+    offsets = [0]
+    dim = None
+    with open(os.path.join(tmp_path, VECTORS_FILE), "wb") as vectors_file, \
+            open(os.path.join(tmp_path, DOCUMENTS_FILE), "wb") as documents_file:
+        for ids in index.list(namespace=namespace, limit=batch_size):
+            fetched = index.fetch(ids=list(ids), namespace=namespace).vectors
+            rows = [fetched[i] for i in ids if i in fetched]
+            if not rows:
+                continue
+            matrix = normalize_rows([row.values for row in rows])
+            dim = dim or matrix.shape[1]
+            vectors_file.write(matrix.tobytes())
+            for row in rows:
+                metadata = dict(row.metadata or {})
+                text = metadata.pop(text_key, "")
+                line = json.dumps({"id": row.id, "text": text, "metadata": metadata}).encode("utf-8") + b"\n"
+                documents_file.write(line)
+                offsets.append(offsets[-1] + len(line))
+            logger.info(f"Exported {len(offsets) - 1} vectors")
+    np.asarray(offsets, dtype=np.int64).tofile(os.path.join(tmp_path, OFFSETS_FILE))
+    with open(os.path.join(tmp_path, META_FILE), "w") as f:
+        json.dump({
+            "dim": dim,
+            "count": len(offsets) - 1,
+            "metric": "cosine",
+            "source_index": index_name,
+            "namespace": namespace,
+            "exported_at": datetime.now(timezone.utc).isoformat(),
+        }, f)
+    if os.path.exists(path):
+        os.rename(path, path + ".old")
+    os.rename(tmp_path, path)
+    if os.path.exists(path + ".old"):
+        shutil.rmtree(path + ".old")
+    logger.info(f"Snapshot of {index_name} written to {path}")
+
+
+def _replace_file(target: str, write, mode: str = "wb"):
+    # Running workers may have the current file memory-mapped; rewriting it in place
+    # can SIGBUS them, so the new content goes to a fresh file that is swapped in
+    tmp_path = target + ".tmp"
+    with open(tmp_path, mode) as f:
+        write(f)
+    os.replace(tmp_path, target)
+
+
+def build_ivf(path: str, nlist: int, iterations: int, sample_size: int, seed: int = 0):
+    # Spherical k-means on a sample, then every row is assigned to its nearest centroid
+    with open(os.path.join(path, META_FILE)) as f:
+        meta = json.load(f)
+    vectors = np.memmap(os.path.join(path, VECTORS_FILE), dtype=np.float32, mode="r",
+                        shape=(meta["count"], meta["dim"]))
+    rng = np.random.default_rng(seed)
+    sample = np.asarray(vectors[np.sort(rng.choice(len(vectors), min(sample_size, len(vectors)), replace=False))])
+    centroids = sample[rng.choice(len(sample), nlist, replace=False)]
+    for _ in range(iterations):
+        assign = np.argmax(sample @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, sample)
+        empty = np.bincount(assign, minlength=nlist) == 0
+        sums[empty] = sample[rng.choice(len(sample), int(empty.sum()), replace=False)]
+        centroids = normalize_rows(sums)
+
+    assign = np.concatenate([
+        np.argmax(vectors[start:start + 65536] @ centroids.T, axis=1)
+        for start in range(0, len(vectors), 65536)
+    ])
+    order = np.argsort(assign, kind="stable").astype(np.int32)
+    list_offsets = np.concatenate([[0], np.cumsum(np.bincount(assign, minlength=nlist))]).astype(np.int64)
+    _replace_file(os.path.join(path, IVF_CENTROIDS_FILE), centroids.astype(np.float32).tofile)
+    _replace_file(os.path.join(path, IVF_ORDER_FILE), order.tofile)
+    _replace_file(os.path.join(path, IVF_OFFSETS_FILE), list_offsets.tofile)
+    meta["ivf_nlist"] = nlist
+    _replace_file(os.path.join(path, META_FILE), lambda f: json.dump(meta, f), mode="w")
+    logger.info(f"Built {nlist} IVF lists for {len(vectors)} vectors")
+
+
+def _percentiles(samples):
+    return {
+        "p50": float(np.percentile(samples, 50)),
+        "p95": float(np.percentile(samples, 95)),
+        "p99": float(np.percentile(samples, 99)),
+    }
+
+
+def compare(path: str, queries_file: str, index_name: str, namespace: str, k: int, engine: str):
+    from langchain_community.embeddings import OpenAIEmbeddings
+    with open(queries_file) as f:
+        queries = [line.strip() for line in f if line.strip()]
+    query_vectors = OpenAIEmbeddings(api_key=OPENAI_API_KEY).embed_documents(queries)
+    index = _pinecone_index(index_name)
+    local = LocalVectorIndex(path, engine=engine)
+
+    recalls, remote_ms, local_ms = [], [], []
+    for vector in query_vectors:
+        start = time.perf_counter()
+        remote = index.query(vector=vector, top_k=k, namespace=namespace)
+        remote_ms.append((time.perf_counter() - start) * 1000)
+        start = time.perf_counter()
+        rows, _ = local.search_batch([vector], k)
+        local_ms.append((time.perf_counter() - start) * 1000)
+        remote_ids = {match.id for match in remote.matches}
+        local_ids = {local.document(int(r)).metadata["id"] for r in rows[0] if r >= 0}
+        recalls.append(len(remote_ids & local_ids) / len(remote_ids) if remote_ids else 1.0)
+
+    print(json.dumps({
+        "queries": len(queries),
+        "k": k,
+        "engine": local.engine,
+        "recall_at_k": float(np.mean(recalls)),
+        "remote_ms": _percentiles(remote_ms),
+        "local_ms": _percentiles(local_ms),
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local vector index snapshot tooling")
+    parser.add_argument("--path", default=LOCAL_INDEX_PATH)
+    parser.add_argument("--index", default=INDEX_NAME)
+    parser.add_argument("--namespace", default="")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    export_parser = commands.add_parser("export")
+    export_parser.add_argument("--batch-size", type=int, default=100)
+    export_parser.add_argument("--text-key", default="text")
+
+    ivf_parser = commands.add_parser("build-ivf")
+    ivf_parser.add_argument("--nlist", type=int, default=1024)
+    ivf_parser.add_argument("--iterations", type=int, default=20)
+    ivf_parser.add_argument("--sample-size", type=int, default=200000)
+
+    compare_parser = commands.add_parser("compare")
+    compare_parser.add_argument("queries_file")
+    compare_parser.add_argument("--k", type=int, default=4)
+    compare_parser.add_argument("--engine", default="flat")
+
+    args = parser.parse_args()
+    if args.command == "export":
+        export(args.path, args.index, args.namespace, args.batch_size, args.text_key)
+    elif args.command == "build-ivf":
+        build_ivf(args.path, args.nlist, args.iterations, args.sample_size)
+    else:
+        compare(args.path, args.queries_file, args.index, args.namespace, args.k, args.engine)
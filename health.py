@@ -0,0 +1,52 @@
+import time
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Captured when main imports this module, i.e. at worker boot
+PROCESS_STARTED = time.monotonic()
+
+# name -> {"status": "pending" | "ok" | "error", "latency_ms": float, "error": str}
+dependencies = {}
+ready_at = None
+
+
+async def _run_check(name: str, check):
+    started = time.monotonic()
+    try:
+        await check()
+        dependencies[name] = {"status": "ok", "latency_ms": round((time.monotonic() - started) * 1000, 1)}
+    except Exception as e:
+        logger.error(f"Warm-up check {name} failed: {e}")
+        dependencies[name] = {
+            "status": "error",
+            "latency_ms": round((time.monotonic() - started) * 1000, 1),
+            "error": str(e),
+        }
+
+
+async def warm_up(checks: dict, retry_interval: float = 5.0):
+    # Runs every check concurrently; failed ones are retried until all pass
+    global ready_at
+    for name in checks:
+        dependencies[name] = {"status": "pending"}
+    pending = dict(checks)
+    while pending:
+        await asyncio.gather(*(_run_check(name, check) for name, check in pending.items()))
+        pending = {name: check for name, check in pending.items() if dependencies[name]["status"] != "ok"}
+        if pending:
+            await asyncio.sleep(retry_interval)
+    ready_at = time.monotonic()
+    logger.info(f"Ready {round((ready_at - PROCESS_STARTED) * 1000)} ms after boot")
+
+
+def readiness():
+    payload = {
+        "ready": ready_at is not None,
+        "uptime_s": round(time.monotonic() - PROCESS_STARTED, 1),
+        "dependencies": dependencies,
+    }
+    if ready_at is not None:
+        payload["time_to_ready_ms"] = round((ready_at - PROCESS_STARTED) * 1000, 1)
+    return payload
@@ -0,0 +1,200 @@
+import os
+import uuid
+import heapq
+import socket
+import asyncio
+import logging
+import itertools
+from datetime import datetime, timedelta, timezone
+from pymongo import errors
+from database import Jobs, QueryQuota
+from query import aprocess_query
+
+logger = logging.getLogger(__name__)
+
+# Background queries: POST /jobs enqueues and returns a job id, a worker runs the
+# pipeline and stores the answer for JOB_RESULT_TTL, GET /jobs/{id} polls or
+# long-polls for it. "mongo" shares the queue with worker.py processes that scale
+# separately from the web tier; "local" keeps it in the web process for development.
+JOB_QUEUE_BACKEND = os.getenv("JOB_QUEUE_BACKEND", "mongo")
+JOB_QUEUE_MAX_DEPTH = int(os.getenv("JOB_QUEUE_MAX_DEPTH", "1000"))
+# Free-tier submissions are shed first, once the queue is this full
+JOB_QUEUE_FREE_DEPTH_RATIO = float(os.getenv("JOB_QUEUE_FREE_DEPTH_RATIO", "0.8"))
+JOB_RESULT_TTL = int(os.getenv("JOB_RESULT_TTL", "3600"))
+JOB_LEASE_SECONDS = int(os.getenv("JOB_LEASE_SECONDS", "300"))
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", "1"))
+JOB_LOCAL_WORKERS = int(os.getenv("JOB_LOCAL_WORKERS", "2"))
+
+SUBSCRIBER_PRIORITY = 1
+FREE_PRIORITY = 0
+
+
+class QueueFull(Exception):
+    pass
+
+
+def new_job(query: str, user: dict, reservation: str) -> dict:
+    now = datetime.now(timezone.utc)
+    return {
+        "_id": uuid.uuid4().hex,
+        "status": "queued",
+        "priority": SUBSCRIBER_PRIORITY if user.get("is_subscriber") else FREE_PRIORITY,
+        "query": query,
+        "google_user_id": user["google_user_id"],
+        "reservation": reservation,
+        "created_at": now,
+        # expires_at is only set when the job finishes, so the TTL never drops a
+        # queued job (and its quota reservation) that is still waiting for a worker
+    }
+
+
+def depth_limit(priority: int) -> int:
+    if priority >= SUBSCRIBER_PRIORITY:
+        return JOB_QUEUE_MAX_DEPTH
+    return int(JOB_QUEUE_MAX_DEPTH * JOB_QUEUE_FREE_DEPTH_RATIO)
+
+
+def _finished_fields(result=None, error=None) -> dict:
+    now = datetime.now(timezone.utc)
+    fields = {
+        "status": "failed" if error else "done",
+        "finished_at": now,
+        "expires_at": now + timedelta(seconds=JOB_RESULT_TTL),
+    }
+    if error:
+        fields["error"] = error
+    else:
+        fields["result"] = result
+    return fields
+
+
+class MongoJobQueue:
+    def __init__(self):
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+
+    async def submit(self, job: dict):
+        if await Jobs.queued_count() >= depth_limit(job["priority"]):
+            raise QueueFull()
+        await Jobs.create(job)
+        return job["_id"]
+
+    async def get(self, job_id: str):
+        return await Jobs.get(job_id)
+
+    async def wait(self, job_id: str, timeout: float):
+        # Change streams need a replica set, so long-polling re-reads the job
+        deadline = asyncio.get_running_loop().time() + timeout
+        while True:
+            job = await Jobs.get(job_id)
+            if job is None or job["status"] in ("done", "failed"):
+                return job
+            remaining = deadline - asyncio.get_running_loop().time()
+            if remaining <= 0:
+                return job
+            await asyncio.sleep(min(JOB_POLL_INTERVAL, remaining))
+
+    async def claim(self):
+        job = await Jobs.claim(self.worker_id, timedelta(seconds=JOB_LEASE_SECONDS))
+        if job is None:
+            await asyncio.sleep(JOB_POLL_INTERVAL)
+        return job
+
+    async def finish(self, job_id: str, result=None, error=None):
+        await Jobs.finish(job_id, _finished_fields(result, error))
+
+
+class LocalJobQueue:
+    # In-process queue for development: jobs live in this process only and are
+    # run by workers started alongside the app
+    def __init__(self):
+        self._jobs = {}
+        self._heap = []
+        self._sequence = itertools.count()
+        self._available = asyncio.Condition()
+        self._done = {}
+
+    def _evict_expired(self):
+        now = datetime.now(timezone.utc)
+        expired = [job_id for job_id, job in self._jobs.items() if job.get("expires_at") and job["expires_at"] < now]
+        for job_id in expired:
+            del self._jobs[job_id]
+            self._done.pop(job_id, None)
+
+    async def submit(self, job: dict):
+        self._evict_expired()
+        if len(self._heap) >= depth_limit(job["priority"]):
+            raise QueueFull()
+        self._jobs[job["_id"]] = job
+        self._done[job["_id"]] = asyncio.Event()
+        async with self._available:
+            heapq.heappush(self._heap, (-job["priority"], next(self._sequence), job["_id"]))
+            self._available.notify()
+        return job["_id"]
+
+    async def get(self, job_id: str):
+        return self._jobs.get(job_id)
+
+    async def wait(self, job_id: str, timeout: float):
+        done = self._done.get(job_id)
+        if done is not None:
+            try:
+                await asyncio.wait_for(done.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return self._jobs.get(job_id)
+
+    async def claim(self):
+        async with self._available:
+            while True:
+                try:
+                    await asyncio.wait_for(self._available.wait_for(lambda: self._heap), JOB_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    return None
+                _, _, job_id = heapq.heappop(self._heap)
+                # Skip entries whose job was evicted in the meantime
+                job = self._jobs.get(job_id)
+                if job is not None:
+                    break
+        job.update(status="running", started_at=datetime.now(timezone.utc))
+        return job
+
+    async def finish(self, job_id: str, result=None, error=None):
+        job = self._jobs.get(job_id)
+        if job is None:
+            return
+        job.update(_finished_fields(result, error))
+        self._done[job_id].set()
+
+
+def create_queue():
+    if JOB_QUEUE_BACKEND == "local":
+        return LocalJobQueue()
+    return MongoJobQueue()
+
+
+async def run_job(queue, job: dict):
+    try:
+        response = await aprocess_query(job["query"], session_id=job["google_user_id"])
+    except Exception as e:
+        logger.error(f"Job {job['_id']} failed: {e}")
+        await QueryQuota.refund(job["reservation"])
+        await queue.finish(job["_id"], error="Error processing query")
+        return
+    await queue.finish(job["_id"], result=response)
+    logger.info(f"Job {job['_id']} finished for user {job['google_user_id']}")
+
+
+async def run_workers(queue, concurrency: int, stop: asyncio.Event):
+    # Each loop runs one job at a time; a set stop event lets running jobs finish
+    async def work():
+        while not stop.is_set():
+            try:
+                job = await queue.claim()
+                if job is not None:
+                    await run_job(queue, job)
+            except errors.PyMongoError as e:
+                # An unfinished job's lease runs out and another worker picks it up
+                logger.error(f"Job queue error: {e}")
+                await asyncio.sleep(JOB_POLL_INTERVAL)
+
+    await asyncio.gather(*(work() for _ in range(concurrency)))
@@ -0,0 +1,123 @@
+import os
+import json
+import mmap
+import logging
+import numpy as np
+from langchain_core.documents import Document
+
+logger = logging.getLogger(__name__)
+
+# Configuration for the in-process vector index replica
+LOCAL_INDEX_PATH = os.getenv("LOCAL_INDEX_PATH", "data/medicalcorpus-v5")
+LOCAL_INDEX_ENGINE = os.getenv("LOCAL_INDEX_ENGINE", "flat")  # flat or ivf
+LOCAL_INDEX_NPROBE = int(os.getenv("LOCAL_INDEX_NPROBE", "8"))
+
+# Snapshot layout written by export_index.py
+VECTORS_FILE = "vectors.f32"          # N x dim float32, L2-normalized
+DOCUMENTS_FILE = "documents.jsonl"    # one {"id", "text", "metadata"} object per row
+OFFSETS_FILE = "offsets.i64"          # N + 1 byte offsets; row i spans offsets[i]:offsets[i + 1]
+META_FILE = "meta.json"
+IVF_CENTROIDS_FILE = "ivf_centroids.f32"
+IVF_ORDER_FILE = "ivf_order.i32"      # rows grouped by cluster
+IVF_OFFSETS_FILE = "ivf_offsets.i64"  # cluster c spans ivf_order[offsets[c]:offsets[c + 1]]
+
+
+def normalize_rows(matrix):
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def _top_k(scores, k: int):
+    # Indices of the k best scores per row, best first
+    k = min(k, scores.shape[-1])
+    part = np.argpartition(-scores, k - 1, axis=-1)[..., :k]
+    order = np.argsort(-np.take_along_axis(scores, part, axis=-1), axis=-1)
+    return np.take_along_axis(part, order, axis=-1)
+
+
+class LocalVectorIndex:
+    # Read-only replica of the Pinecone corpus served from inside the process.
+    # Vectors and documents are memory-mapped, so every worker on the host shares
+    # the same page-cache pages. Exposes the subset of the vector store API used by
+    # query.py, so it is a drop-in retriever backend.
+    def __init__(self, path: str = LOCAL_INDEX_PATH, engine: str = LOCAL_INDEX_ENGINE,
+                 nprobe: int = LOCAL_INDEX_NPROBE):
+        self.path = path
+        self.nprobe = nprobe
+        with open(os.path.join(path, META_FILE)) as f:
+            self.meta = json.load(f)
+        self.dim = self.meta["dim"]
+        self.count = self.meta["count"]
+        self.vectors = np.memmap(os.path.join(path, VECTORS_FILE), dtype=np.float32, mode="r",
+                                 shape=(self.count, self.dim))
+        self._offsets = np.memmap(os.path.join(path, OFFSETS_FILE), dtype=np.int64, mode="r")
+        self._documents_file = open(os.path.join(path, DOCUMENTS_FILE), "rb")
+        self._documents = mmap.mmap(self._documents_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        self.engine = engine
+        if engine not in ("flat", "ivf"):
+            # Any private in-memory copy (e.g. a FAISS flat index) would defeat the shared mmap
+            logger.warning(f"Unknown local index engine {engine}, falling back to brute-force search")
+            self.engine = "flat"
+        if engine == "ivf" and not os.path.exists(os.path.join(path, IVF_CENTROIDS_FILE)):
+            logger.warning("No IVF lists in snapshot, falling back to brute-force search")
+            self.engine = "flat"
+
+        if self.engine == "ivf":
+            nlist = self.meta["ivf_nlist"]
+            self._centroids = np.memmap(os.path.join(path, IVF_CENTROIDS_FILE), dtype=np.float32, mode="r",
+                                        shape=(nlist, self.dim))
+            self._ivf_order = np.memmap(os.path.join(path, IVF_ORDER_FILE), dtype=np.int32, mode="r")
+            self._ivf_offsets = np.memmap(os.path.join(path, IVF_OFFSETS_FILE), dtype=np.int64, mode="r")
+        logger.info(f"Loaded local index {path}: {self.count} vectors, dim {self.dim}, engine {self.engine}")
+
+    def document(self, row: int) -> Document:
+        record = json.loads(self._documents[int(self._offsets[row]):int(self._offsets[row + 1])])
+        metadata = dict(record.get("metadata") or {})
+        metadata["id"] = record["id"]
+        return Document(page_content=record["text"], metadata=metadata)
+
+    def search_batch(self, queries, k: int = 4):
+        # Returns (rows, scores), each shaped (len(queries), k)
+        queries = normalize_rows(np.atleast_2d(queries))
+        k = min(k, self.count)
+        if self.engine == "ivf":
+            return self._search_ivf(queries, k)
+        scores = queries @ self.vectors.T
+        rows = _top_k(scores, k)
+        return rows, np.take_along_axis(scores, rows, axis=-1)
+
+    def search_batch_with_vectors(self, queries, k: int = 4):
+        # Candidates with their stored vectors for re-ranking; rows of -1 are padding
+        rows, _ = self.search_batch(queries, k)
+        return rows, np.asarray(self.vectors[np.maximum(rows, 0)])
+
+    def search_with_vectors(self, embedding, k: int = 4):
+        rows, vectors = self.search_batch_with_vectors([embedding], k)
+        keep = rows[0] >= 0
+        return [self.document(int(r)) for r in rows[0][keep]], vectors[0][keep]
+
+    def _search_ivf(self, queries, k: int):
+        probes = _top_k(queries @ self._centroids.T, min(self.nprobe, self._centroids.shape[0]))
+        all_rows = np.full((len(queries), k), -1, dtype=np.int64)
+        all_scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        for i, clusters in enumerate(probes):
+            candidates = np.concatenate([
+                self._ivf_order[self._ivf_offsets[c]:self._ivf_offsets[c + 1]] for c in clusters
+            ])
+            if not len(candidates):
+                continue
+            scores = self.vectors[candidates] @ queries[i]
+            best = _top_k(scores[None, :], k)[0]
+            all_rows[i, :len(best)] = candidates[best]
+            all_scores[i, :len(best)] = scores[best]
+        return all_rows, all_scores
+
+    def similarity_search_by_vector_with_score(self, embedding, k: int = 4, **kwargs):
+        rows, scores = self.search_batch([embedding], k)
+        return [(self.document(int(r)), float(s)) for r, s in zip(rows[0], scores[0]) if r >= 0]
+
+    def similarity_search_by_vector(self, embedding, k: int = 4, **kwargs):
+        return [doc for doc, _ in self.similarity_search_by_vector_with_score(embedding, k)]
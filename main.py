@@ -1,12 +1,27 @@
-from fastapi import FastAPI, HTTPException, status, Query
-from pymongo import MongoClient
+from fastapi import FastAPI, HTTPException, status, Query, Request, Header
+from fastapi.responses import StreamingResponse, JSONResponse, PlainTextResponse
 from auth import router as auth_router
 from payment import router as payment_router
 from dotenv import load_dotenv
 import uvicorn
 import os
+import json
+import anyio
+import asyncio
 import logging
-from query import process_query
+import health
+import stripe_events
+import sessions
+import jobs
+import metrics
+from metrics import span
+from query import (
+    aprocess_query, astream_query, answer_cache, memory, check_vectorstore, check_openai, check_tokenizer,
+)
+from resilience import UpstreamUnavailable
+from quota import query_limit
+from ratelimit import RateLimitMiddleware
+from database import QueryQuota, ensure_indexes, ping
 
 # Load environment variables and initialize logging
 load_dotenv()
@@ -15,51 +30,216 @@ logger = logging.getLogger(__name__)
 
 # Create the FastAPI app instance
 app = FastAPI()
+# Rate limiting runs inside the timing middleware, so rejections still show up in /metrics
+app.add_middleware(RateLimitMiddleware)
+app.add_middleware(metrics.ServerTimingMiddleware)
 
-# MongoDB configuration
-MONGO_URI = os.getenv("MONGO_URI", "mongodb://localhost:27017")
-client = MongoClient(MONGO_URI)
-db = client["mydatabase"]
-users_collection = db["users"]
+# Cap on concurrently running RAG pipelines per worker process
+QUERY_CONCURRENCY = int(os.getenv("QUERY_CONCURRENCY", "256"))
+query_semaphore = asyncio.Semaphore(QUERY_CONCURRENCY)
 
-@app.post("/query")
-async def query_endpoint(
-    query: str = Query(..., min_length=3, max_length=500, regex=r'^[a-zA-Z0-9\s?.,-]+$'),
-    user_email: str = Query(..., description="The email of the user making the query")
-):
-    user = users_collection.find_one({"email": user_email})
-    if not user:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="User not found"
+# Background jobs; GET /jobs/{id} holds a long-poll open for at most this long
+JOB_MAX_WAIT = float(os.getenv("JOB_MAX_WAIT", "30"))
+JOB_RETRY_AFTER = int(os.getenv("JOB_RETRY_AFTER", "5"))
+job_queue = jobs.create_queue()
+
+async def check_mongo():
+    await ping()
+    await ensure_indexes()
+    await answer_cache.ensure_indexes()
+    await memory.ensure_indexes()
+
+# Warm-up runs in the background so the worker accepts connections immediately;
+# /readyz reports 503 until every dependency has checked out
+@app.on_event("startup")
+async def startup():
+    app.state.warm_up = asyncio.create_task(health.warm_up({
+        "mongo": check_mongo,
+        "vectorstore": check_vectorstore,
+        "openai": check_openai,
+        "tokenizer": check_tokenizer,
+        "session_secret": sessions.check_secret,
+    }))
+    if memory.collection is not None:
+        app.state.chat_history_writer = asyncio.create_task(memory.run_write_behind())
+    app.state.stripe_consumer = asyncio.create_task(stripe_events.run_consumer())
+    app.state.revocation_poller = asyncio.create_task(sessions.run_revocation_poller())
+    if jobs.JOB_QUEUE_BACKEND == "local":
+        app.state.job_workers = asyncio.create_task(
+            jobs.run_workers(job_queue, jobs.JOB_LOCAL_WORKERS, asyncio.Event())
         )
 
-    query_limit = 70 if user.get("is_subscriber") else 3
-    current_query_count = user.get("query_count", 0)
+@app.on_event("shutdown")
+async def shutdown():
+    for name in ("warm_up", "chat_history_writer", "stripe_consumer", "revocation_poller", "job_workers"):
+        task = getattr(app.state, name, None)
+        if task is not None:
+            task.cancel()
+    await memory.flush()
+
+@app.get("/healthz")
+async def healthz():
+    return {"status": "ok"}
+
+@app.get("/readyz")
+async def readyz():
+    payload = health.readiness()
+    return JSONResponse(payload, status_code=status.HTTP_200_OK if payload["ready"] else status.HTTP_503_SERVICE_UNAVAILABLE)
+
+# Prometheus text exposition of stage latencies, token counts and cache hit rates
+@app.get("/metrics")
+async def metrics_endpoint():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
 
-    if current_query_count >= query_limit:
+# Identifies the user and reserves one query from today's quota before any LLM work.
+# A bearer session token is verified locally; user_email costs a user-document read.
+async def reserve_user_query(authorization: str, user_email: str):
+    with span("user_lookup"):
+        user = await sessions.resolve_user(authorization, user_email)
+
+    with span("quota"):
+        reservation = await QueryQuota.reserve(user["google_user_id"], query_limit(user.get("is_subscriber", False)))
+    if reservation is None:
         logger.warning(f"User {user['google_user_id']} exceeded query limit.")
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="Query limit exceeded for the day."
         )
+    return user, reservation
+
+@app.post("/query")
+async def query_endpoint(
+    query: str = Query(..., min_length=3, max_length=500, regex=r'^[a-zA-Z0-9\s?.,-]+$'),
+    user_email: str = Query(None, description="The email of the user making the query, if no session token is sent"),
+    authorization: str = Header(None),
+):
+    user, reservation = await reserve_user_query(authorization, user_email)
 
     try:
-        response = process_query(query)
+        async with query_semaphore:
+            response = await aprocess_query(query, session_id=user["google_user_id"])
         logger.info(f"Query processed for user {user['google_user_id']}")
-
-        users_collection.update_one(
-            {"google_user_id": user["google_user_id"]},
-            {"$inc": {"query_count": 1}}
-        )
         return {"response": response}
+    except HTTPException:
+        # Degraded upstreams surface as 503 with Retry-After rather than a generic 500
+        with span("quota"):
+            await QueryQuota.refund(reservation)
+        raise
     except Exception as e:
         logger.error(f"Error processing query: {e}")
+        with span("quota"):
+            await QueryQuota.refund(reservation)
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail="Error processing query"
         )
 
+# Server-sent events variant of /query: tokens are emitted as the model produces them
+@app.post("/query/stream")
+async def query_stream_endpoint(
+    request: Request,
+    query: str = Query(..., min_length=3, max_length=500, regex=r'^[a-zA-Z0-9\s?.,-]+$'),
+    user_email: str = Query(None, description="The email of the user making the query, if no session token is sent"),
+    authorization: str = Header(None),
+):
+    user, reservation = await reserve_user_query(authorization, user_email)
+
+    async def event_stream():
+        completed = False
+        stream = None
+        try:
+            async with query_semaphore:
+                stream = astream_query(query, session_id=user["google_user_id"])
+                try:
+                    async for chunk in stream:
+                        if await request.is_disconnected():
+                            logger.info(f"Client disconnected, cancelling stream for user {user['google_user_id']}")
+                            return
+                        yield f"data: {json.dumps(chunk)}\n\n"
+                except UpstreamUnavailable as e:
+                    logger.error(f"Error streaming query: {e}")
+                    yield f"event: error\ndata: {json.dumps('Service temporarily degraded, please retry shortly')}\n\n"
+                    return
+                except Exception as e:
+                    logger.error(f"Error streaming query: {e}")
+                    yield f"event: error\ndata: {json.dumps('Error processing query')}\n\n"
+                    return
+            completed = True
+            logger.info(f"Query streamed for user {user['google_user_id']}")
+            yield "event: done\ndata: {}\n\n"
+        except asyncio.CancelledError:
+            # Starlette cancels the response task when the client goes away
+            logger.info(f"Client disconnected, cancelling stream for user {user['google_user_id']}")
+            raise
+        finally:
+            # Shielded, or the already-cancelled scope would cancel the cleanup too.
+            # Closing the generator cancels the upstream generation.
+            with anyio.CancelScope(shield=True):
+                if stream is not None:
+                    await stream.aclose()
+                if not completed:
+                    await QueryQuota.refund(reservation)
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+# Job variant of /query for long answers: returns a job id at once and a worker
+# runs the pipeline, so no connection is held open for the whole generation
+@app.post("/jobs", status_code=status.HTTP_202_ACCEPTED)
+async def submit_job(
+    query: str = Query(..., min_length=3, max_length=500, regex=r'^[a-zA-Z0-9\s?.,-]+$'),
+    user_email: str = Query(None, description="The email of the user making the query, if no session token is sent"),
+    authorization: str = Header(None),
+):
+    user, reservation = await reserve_user_query(authorization, user_email)
+
+    try:
+        job_id = await job_queue.submit(jobs.new_job(query, user, reservation))
+    except jobs.QueueFull:
+        await QueryQuota.refund(reservation)
+        logger.warning(f"Job queue full, rejected job for user {user['google_user_id']}")
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Too many queued jobs, please retry later",
+            headers={"Retry-After": str(JOB_RETRY_AFTER)},
+        )
+    except Exception as e:
+        logger.error(f"Error submitting job: {e}")
+        await QueryQuota.refund(reservation)
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="Error submitting job"
+        )
+    logger.info(f"Job {job_id} queued for user {user['google_user_id']}")
+    return {"job_id": job_id, "status": "queued"}
+
+@app.get("/jobs/{job_id}")
+async def get_job(
+    job_id: str,
+    wait: float = Query(0, ge=0, le=JOB_MAX_WAIT, description="Seconds to wait for the job to finish"),
+    user_email: str = Query(None),
+    authorization: str = Header(None),
+):
+    user = await sessions.resolve_user(authorization, user_email)
+    job = await job_queue.get(job_id)
+    if job is None or job["google_user_id"] != user["google_user_id"]:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Job not found"
+        )
+    if wait and job["status"] not in ("done", "failed"):
+        job = await job_queue.wait(job_id, wait) or job
+
+    payload = {"job_id": job_id, "status": job["status"]}
+    if job["status"] == "done":
+        payload["response"] = job["result"]
+    elif job["status"] == "failed":
+        payload["error"] = job["error"]
+    return payload
+
 # Include routers
 app.include_router(auth_router, prefix="/auth", tags=["Authentication"])
 app.include_router(payment_router, prefix="/payment", tags=["Payment"])
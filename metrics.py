@@ -0,0 +1,241 @@
+import time
+import bisect
+import logging
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from langchain_core.callbacks import BaseCallbackHandler
+
+logger = logging.getLogger(__name__)
+
+# Latency buckets in seconds, spanning Mongo point lookups to full LLM generations
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Stage timings of the current request, read back into the Server-Timing header
+_request_timings = ContextVar("request_timings", default=None)
+
+
+def _format_labels(names, values):
+    if not names:
+        return ""
+    return "{" + ",".join(f'{n}="{v}"' for n, v in zip(names, values)) + "}"
+
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._series = {}  # label values -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [0] * (len(self.buckets) + 2)
+            # Values above the last bound only show up in +Inf, which is the total count
+            if index < len(self.buckets):
+                series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = {k: list(v) for k, v in self._series.items()}
+        for label_values, values in sorted(series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, values):
+                cumulative += count
+                labels = _format_labels(self.labels + ("le",), label_values + (repr(bound),))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labels + ("le",), label_values + ("+Inf",))
+            lines.append(f"{self.name}_bucket{labels} {values[-1]}")
+            base = _format_labels(self.labels, label_values)
+            lines.append(f"{self.name}_sum{base} {values[-2]}")
+            lines.append(f"{self.name}_count{base} {values[-1]}")
+        return lines
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, *label_values):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            values = dict(self._values)
+        for label_values, value in sorted(values.items()):
+            lines.append(f"{self.name}{_format_labels(self.labels, label_values)} {value}")
+        return lines
+
+
+class Gauge:
+    # Value is read from a callback at scrape time, so the hot path pays nothing
+    def __init__(self, name: str, help_text: str, callback, labels=()):
+        self.name = name
+        self.help = help_text
+        self.callback = callback
+        self.labels = tuple(labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        try:
+            values = self.callback()
+        except Exception as e:
+            logger.error(f"Error reading gauge {self.name}: {e}")
+            return lines
+        if not isinstance(values, dict):
+            values = {(): values}
+        for label_values, value in sorted(values.items()):
+            if not isinstance(label_values, tuple):
+                label_values = (label_values,)
+            lines.append(f"{self.name}{_format_labels(self.labels, label_values)} {value}")
+        return lines
+
+
+_registry = []
+
+
+def histogram(name: str, help_text: str, labels=(), buckets=DEFAULT_BUCKETS) -> Histogram:
+    metric = Histogram(name, help_text, labels, buckets)
+    _registry.append(metric)
+    return metric
+
+
+def counter(name: str, help_text: str, labels=()) -> Counter:
+    metric = Counter(name, help_text, labels)
+    _registry.append(metric)
+    return metric
+
+
+def gauge(name: str, help_text: str, callback, labels=()) -> Gauge:
+    metric = Gauge(name, help_text, callback, labels)
+    _registry.append(metric)
+    return metric
+
+
+def render() -> str:
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+stage_duration = histogram("rag_stage_duration_seconds", "Time spent in each stage of a query", labels=("stage",))
+request_duration = histogram(
+    "http_request_duration_seconds", "HTTP request latency", labels=("method", "path", "status")
+)
+llm_tokens = counter("rag_llm_tokens_total", "Tokens reported by the LLM provider", labels=("type",))
+
+
+def record_stage(stage: str, seconds: float):
+    stage_duration.observe(seconds, stage)
+    timings = _request_timings.get()
+    if timings is not None:
+        timings.append((stage, seconds))
+
+
+@contextmanager
+def span(stage: str):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.perf_counter() - started)
+
+
+def start_request():
+    timings = []
+    _request_timings.set(timings)
+    return timings
+
+
+def server_timing_header(timings, total: float) -> str:
+    # Repeated stages (e.g. two Mongo calls) are summed into one entry
+    merged = {}
+    for stage, seconds in timings:
+        merged[stage] = merged.get(stage, 0.0) + seconds
+    entries = [f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in merged.items()]
+    entries.append(f"total;dur={total * 1000:.1f}")
+    return ", ".join(entries)
+
+
+class LLMTimingCallback(BaseCallbackHandler):
+    # Times LLM calls inside retrieval_chain and records provider token usage.
+    # run_inline keeps it in the request's context so it reaches Server-Timing.
+    run_inline = True
+
+    def __init__(self):
+        self._started = {}
+        self._first_token = set()
+
+    def on_llm_start(self, serialized, prompts, *, run_id, **kwargs):
+        self._started[run_id] = time.perf_counter()
+
+    def on_llm_new_token(self, token, *, run_id, **kwargs):
+        if run_id not in self._first_token and run_id in self._started:
+            self._first_token.add(run_id)
+            record_stage("llm_first_token", time.perf_counter() - self._started[run_id])
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        started = self._started.pop(run_id, None)
+        self._first_token.discard(run_id)
+        if started is not None:
+            record_stage("llm", time.perf_counter() - started)
+        usage = (response.llm_output or {}).get("token_usage") or {}
+        for kind in ("prompt_tokens", "completion_tokens"):
+            if usage.get(kind):
+                llm_tokens.inc(usage[kind], kind.split("_")[0])
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        self._started.pop(run_id, None)
+        self._first_token.discard(run_id)
+
+
+llm_timing = LLMTimingCallback()
+
+
+class ServerTimingMiddleware:
+    # Plain ASGI middleware: adds a Server-Timing header with the stages recorded
+    # before the response started and observes the full request duration. Streaming
+    # responses start early, so their header only carries the pre-stream stages.
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        started = time.perf_counter()
+        timings = start_request()
+        status_code = 500
+
+        async def send_with_timing(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                header = server_timing_header(timings, time.perf_counter() - started)
+                message = dict(message, headers=list(message.get("headers", [])) + [
+                    (b"server-timing", header.encode("latin-1")),
+                ])
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            # Label by route template so path parameters cannot blow up cardinality
+            route = scope.get("route")
+            path = getattr(route, "path", "unmatched")
+            request_duration.observe(time.perf_counter() - started, scope["method"], path, str(status_code))
@@ -1,19 +1,19 @@
 import stripe
 import os
-from pymongo import MongoClient
-from fastapi import HTTPException, status, APIRouter, Request
+import json
+from fastapi import HTTPException, status, APIRouter, Request, Header
 import logging
+from pymongo import errors
+from database import StripeEvents
+from sessions import resolve_user
+import stripe_events
 
 # Environment variables
 stripe.api_key = os.getenv("STRIPE_API_KEY")
 STRIPE_WEBHOOK_SECRET = os.getenv("STRIPE_WEBHOOK_SECRET")
-MONGO_URI = os.getenv("MONGO_URI", "mongodb://localhost:27017")
 
-# Initialize logging and database
+# Initialize logging
 logger = logging.getLogger(__name__)
-client = MongoClient(MONGO_URI)
-db = client["mydatabase"]
-users_collection = db["users"]
 
 # Payment router setup
 router = APIRouter()
@@ -30,9 +30,9 @@ def create_stripe_checkout_session(user):
             mode='subscription',
             success_url='https://your-domain.com/success',
             cancel_url='https://your-domain.com/cancel',
-            client_reference_id=user["_id"],
+            client_reference_id=user["google_user_id"],
         )
-        logger.info(f"Checkout session created for user {user['_id']}")
+        logger.info(f"Checkout session created for user {user['google_user_id']}")
         return checkout_session.url
     except stripe.error.StripeError as e:
         logger.error(f"Stripe error: {e}")
@@ -42,13 +42,8 @@ def create_stripe_checkout_session(user):
         )
 
 @router.post("/create-checkout-session")
-async def create_checkout_session(user_email: str):
-    user = users_collection.find_one({"email": user_email})
-    if not user:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="User not found"
-        )
+async def create_checkout_session(user_email: str = None, authorization: str = Header(None)):
+    user = await resolve_user(authorization, user_email)
 
     checkout_url = create_stripe_checkout_session(user)
     return {"checkout_url": checkout_url}
@@ -58,16 +53,13 @@ async def stripe_webhook(request: Request):
     payload = await request.body()
     sig_header = request.headers.get("Stripe-Signature")
 
+    # Verify, log and acknowledge; stripe_events applies the change in the background
     try:
-        event = stripe.Webhook.construct_event(payload, sig_header, STRIPE_WEBHOOK_SECRET)
-        logger.info("Webhook event verified successfully")
-
-        if event['type'] == 'checkout.session.completed':
-            session = event['data']['object']
-            user_id = session.get('client_reference_id')
-            users_collection.update_one({"_id": user_id}, {"$set": {"is_subscriber": True}})
-            logger.info(f"User {user_id} subscription status updated to active")
-
+        stripe.Webhook.construct_event(payload, sig_header, STRIPE_WEBHOOK_SECRET)
+        event = json.loads(payload)
+        if await StripeEvents.record(event):
+            stripe_events.notify()
+            logger.info(f"Webhook event {event['id']} ({event['type']}) recorded")
         return {"status": "success"}
     except ValueError:
         logger.error("Invalid payload in webhook")
@@ -75,6 +67,13 @@ async def stripe_webhook(request: Request):
     except stripe.error.SignatureVerificationError:
         logger.error("Invalid signature for webhook event")
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid signature")
+    except errors.PyMongoError as e:
+        # Not acknowledged, so Stripe delivers the event again
+        logger.error(f"Error recording webhook event: {e}")
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Could not record webhook event"
+        )
     except Exception as e:
         logger.error(f"Unexpected error in webhook handling: {e}")
         raise HTTPException(
@@ -0,0 +1,84 @@
+import os
+import hashlib
+import logging
+from tokens import count_tokens, truncate_tokens
+
+logger = logging.getLogger(__name__)
+
+# Token budgets for the variable parts of the prompt, and for the prompt as a whole
+PROMPT_MAX_TOKENS = int(os.getenv("PROMPT_MAX_TOKENS", "6000"))
+PROMPT_CONTEXT_TOKEN_BUDGET = int(os.getenv("PROMPT_CONTEXT_TOKEN_BUDGET", "3000"))
+PROMPT_HISTORY_TOKEN_BUDGET = int(os.getenv("PROMPT_HISTORY_TOKEN_BUDGET", "1000"))
+
+CONTEXT_HEADER = "\n\nContext:\n"
+HISTORY_HEADER = "\n\nChat history:\n"
+QUESTION_HEADER = "\n\nHuman: "
+ANSWER_HEADER = "\nAI: "
+CHUNK_SEPARATOR = "\n\n---\n\n"
+
+
+class PromptBuilder:
+    # Renders the RAG prompt with the static instructions first and byte-identical on
+    # every call, so provider-side prompt caching can reuse the prefix. The static
+    # parts are tokenized once by warm() and their count is reserved out of
+    # max_tokens; history turns carry their own counts, so only the question and
+    # retrieved chunks are tokenized per call.
+    def __init__(self, prefix: str, context_budget: int = PROMPT_CONTEXT_TOKEN_BUDGET,
+                 history_budget: int = PROMPT_HISTORY_TOKEN_BUDGET, max_tokens: int = PROMPT_MAX_TOKENS):
+        self.prefix = prefix
+        self.max_tokens = max_tokens
+        self.context_budget = context_budget
+        self.history_budget = history_budget
+        self._layout = prefix + CONTEXT_HEADER + HISTORY_HEADER + QUESTION_HEADER + ANSWER_HEADER
+        self.version = hashlib.sha256(self._layout.encode("utf-8")).hexdigest()[:12]
+        self.static_tokens = None
+        self._separator_tokens = None
+
+    def warm(self):
+        # Loading the tokenizer may download its encoding, so this runs at startup rather than import
+        if self.static_tokens is None:
+            self.static_tokens = count_tokens(self._layout)
+            self._separator_tokens = count_tokens(CHUNK_SEPARATOR)
+            logger.info(f"Prompt prefix version {self.version}: {self.static_tokens} static tokens")
+
+    def trim_context(self, documents, budget: int = None) -> str:
+        # Chunks arrive best-first; keep whole chunks while they fit and cut the last one to the remaining budget
+        self.warm()
+        chunks = []
+        remaining = self.context_budget if budget is None else budget
+        for doc in documents:
+            text = getattr(doc, "page_content", doc)
+            tokens = count_tokens(text) + (self._separator_tokens if chunks else 0)
+            if tokens > remaining:
+                text = truncate_tokens(text, remaining - (self._separator_tokens if chunks else 0))
+                if text:
+                    chunks.append(text)
+                break
+            chunks.append(text)
+            remaining -= tokens
+        return CHUNK_SEPARATOR.join(chunks)
+
+    def trim_history(self, turns):
+        # Newest turns win; whole turns are dropped from the oldest end. Returns (text, tokens used)
+        kept = []
+        remaining = self.history_budget
+        for question, answer, tokens in reversed(turns):
+            if tokens > remaining:
+                break
+            kept.append(f"Human: {question}\nAI: {answer}")
+            remaining -= tokens
+        return "\n".join(reversed(kept)), self.history_budget - remaining
+
+    def build(self, inputs: dict) -> str:
+        self.warm()
+        history, history_tokens = self.trim_history(inputs.get("chat_history") or [])
+        question = inputs["question"]
+        # Retrieved context gets whatever the static prefix, history and question leave of max_tokens
+        left = self.max_tokens - self.static_tokens - history_tokens - count_tokens(question)
+        return (
+            self.prefix
+            + CONTEXT_HEADER + self.trim_context(inputs["context"], min(self.context_budget, left))
+            + HISTORY_HEADER + history
+            + QUESTION_HEADER + question
+            + ANSWER_HEADER
+        )
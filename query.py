@@ -1,43 +1,65 @@
 import os
+import asyncio
 import logging
-from langchain.prompts import PromptTemplate
+import contextvars
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from operator import itemgetter
 from langchain.chains import LLMChain, TransformChain
 from langchain.schema.output_parser import StrOutputParser
-from langchain.schema.runnable import RunnablePassthrough
-from langchain.memory import ConversationBufferWindowMemory
+from langchain.schema.runnable import RunnableLambda
 from dotenv import load_dotenv
-from pymongo import MongoClient
 from pinecone import Pinecone as PineconeClient
 from fastapi import APIRouter, HTTPException
 from langchain_community.embeddings import OpenAIEmbeddings
 from langchain_community.llms import OpenAI
 from langchain_community.vectorstores import Pinecone
+from embedding_cache import CachedEmbeddings, cache_key
+from database import answer_cache_collection, chat_history_collection
+from answer_cache import SemanticAnswerCache, ANSWER_CACHE_ENABLED, ANSWER_CACHE_SHARED
+from chat_memory import ConversationStore, CHAT_HISTORY_PERSIST
+from prompt_builder import PromptBuilder
+from local_index import LocalVectorIndex
+from coalesce import SingleFlight, MicroBatcher, COALESCE_ENABLED
+from metrics import span, llm_timing, gauge
+from rerank import rerank, fetch_candidates, mmr_batch, RERANK_ENABLED, RERANK_FETCH_K
+import numpy as np
+from resilience import (
+    budget, embedding_upstream, retrieval_upstream, llm_upstream, UpstreamUnavailable,
+    EMBEDDING_TIMEOUT, RETRIEVAL_TIMEOUT, LLM_TIMEOUT, FALLBACK_CACHE_THRESHOLD,
+)
 
 # Load environment variables and initialize logging
 load_dotenv()
 logger = logging.getLogger(__name__)
 
-# Configuration for Pinecone, OpenAI, and MongoDB
+# Configuration for Pinecone and OpenAI
 PINECONE_API_KEY = os.getenv("PINECONE_API_KEY")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-MONGO_URI = os.getenv("MONGO_URI", "mongodb://localhost:27017")
 
-if not PINECONE_API_KEY or not OPENAI_API_KEY:
-    logger.error("API keys are missing for Pinecone or OpenAI.")
-    raise RuntimeError("API keys for Pinecone or OpenAI are required.")
+# "pinecone" queries the remote index; "local" serves a snapshot exported with export_index.py
+RETRIEVER_BACKEND = os.getenv("RETRIEVER_BACKEND", "pinecone")
+
+index_name = os.getenv("PINECONE_INDEX_NAME", "medicalcorpus-v5")
+
+# Clients and the chain are built on first use or by warm-up at app startup,
+# so importing this module never touches the network
+embeddings = None
+vectorstore = None
+chat_model = None
+retrieval_chain = None
+_init_lock = threading.Lock()
 
-client = MongoClient(MONGO_URI)
-db = client["mydatabase"]
-users_collection = db["users"]
+RETRIEVAL_K = int(os.getenv("RETRIEVAL_K", "4"))
 
-pc = PineconeClient(api_key=PINECONE_API_KEY)
-index_name = "medicalcorpus-v5"
-if index_name not in pc.list_indexes():
-    logger.error(f"Pinecone index '{index_name}' not found.")
-    raise RuntimeError(f"Pinecone index '{index_name}' is missing. Please create it.")
+# Blocking vector queries run on their own pool so stalled or abandoned (hedged,
+# timed-out) calls cannot exhaust the default executor. Cancelled calls that have
+# not started yet are dropped from its queue.
+RETRIEVAL_THREADS = int(os.getenv("RETRIEVAL_THREADS", "16"))
+retrieval_executor = ThreadPoolExecutor(max_workers=RETRIEVAL_THREADS, thread_name_prefix="retrieval")
 
-embeddings = OpenAIEmbeddings(api_key=OPENAI_API_KEY)
-vectorstore = Pinecone.from_existing_index(index_name=index_name, embedding=embeddings)
+# Client-side retries stay low; hedging and the circuit breakers in resilience.py take over from there
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "1"))
 
 # Define Prompt Template
 guidelines = """
@@ -124,49 +146,336 @@ Remember, your primary goal is to impart knowledge, foster critical thinking, an
 """
 
 
-prompt_template = PromptTemplate.from_template(
-    """
-You are an AI assistant specialized in medical education. Follow these guidelines:
+# Static instructions go first so the prompt prefix is identical across requests
+prompt_builder = PromptBuilder(
+    "You are an AI assistant specialized in medical education. Follow these guidelines:\n\n" + guidelines.strip()
+)
 
-{guidelines}
+# Any edit to the guidelines or prompt layout yields a new version and invalidates cached answers
+PROMPT_VERSION = prompt_builder.version
 
-Context: {context}
-Chat history: {chat_history}
-Human: {question}
-AI: """
+answer_cache = SemanticAnswerCache(
+    namespace=f"{index_name}:{PROMPT_VERSION}",
+    collection=answer_cache_collection if ANSWER_CACHE_SHARED else None,
 )
 
-chat_model = OpenAI(api_key=OPENAI_API_KEY, model_name='gpt-4o-mini')
-memory = ConversationBufferWindowMemory(k=3, memory_key="chat_history")
-
-retrieval_chain = (
-    {
-        "context": vectorstore.as_retriever(),
-        "question": RunnablePassthrough(),
-        "chat_history": lambda _: memory.load_memory_variables({})["chat_history"],
-        "guidelines": lambda _: guidelines,
-    }
-    | prompt_template
-    | chat_model
-    | StrOutputParser()
-)
+# Chat history is kept per user; nothing is shared between sessions
+memory = ConversationStore(collection=chat_history_collection if CHAT_HISTORY_PERSIST else None)
+
+# Retrieval reuses the query embedding computed for the answer cache lookup.
+# With re-ranking on, RERANK_FETCH_K candidates are narrowed to RETRIEVAL_K
+# diverse, non-duplicate chunks.
+def retrieve_context(inputs: dict):
+    # Pinecone queries carry RETRIEVAL_TIMEOUT so a stalled call frees its thread
+    if RERANK_ENABLED:
+        return rerank(vectorstore, inputs["query_vector"], RETRIEVAL_K, timeout=RETRIEVAL_TIMEOUT)
+    documents, _ = fetch_candidates(
+        vectorstore, inputs["query_vector"], RETRIEVAL_K, include_values=False, timeout=RETRIEVAL_TIMEOUT,
+    )
+    return documents
+
+async def _in_retrieval_pool(func, *args):
+    # Like asyncio.to_thread, on the bounded retrieval pool
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(retrieval_executor, lambda: context.run(func, *args))
+
+def _search_local_batch(query_vectors):
+    # Only the chunks that survive re-ranking are read from the document file
+    if not RERANK_ENABLED:
+        rows, _ = vectorstore.search_batch(query_vectors, RETRIEVAL_K)
+        return [[vectorstore.document(int(r)) for r in row if r >= 0] for row in rows]
+    rows, candidates = vectorstore.search_batch_with_vectors(query_vectors, max(RERANK_FETCH_K, RETRIEVAL_K))
+    picks = mmr_batch(np.asarray(query_vectors, dtype=np.float32), candidates, rows >= 0, RETRIEVAL_K)
+    return [[vectorstore.document(int(row[i])) for i in pick if i >= 0] for row, pick in zip(rows, picks)]
+
+def timed_retrieve_context(inputs: dict):
+    with span("retrieval"):
+        return retrieve_context(inputs)
+
+def render_prompt(inputs: dict) -> str:
+    with span("prompt"):
+        return prompt_builder.build(inputs)
+
+# Questions arriving within a few milliseconds of each other share one
+# embed_documents call and one vector query batch. Batches are never hedged: a
+# hedge would resend every item, and under load the extra attempts only queue
+# behind the ones that are already slow.
+async def _embed_batch(texts):
+    unique = {cache_key(text): text for text in texts}
+    results = await embedding_upstream.call(
+        lambda: embeddings.aembed_documents(list(unique.values())), shape="batch", hedge=False,
+    )
+    vectors = dict(zip(unique, results))
+    return [vectors[cache_key(text)] for text in texts]
+
+async def _retrieve_batch(query_vectors):
+    if hasattr(vectorstore, "search_batch"):
+        # The local index scores and re-ranks the whole batch with matrix products
+        return await _in_retrieval_pool(_search_local_batch, query_vectors)
+    # Pinecone has no multi-vector query; issue the batch concurrently
+    return await retrieval_upstream.call(lambda: asyncio.gather(*(
+        _in_retrieval_pool(retrieve_context, {"query_vector": vector}) for vector in query_vectors
+    )), shape="batch", hedge=False)
+
+embedding_batcher = MicroBatcher(_embed_batch, name="embedding")
+retrieval_batcher = MicroBatcher(_retrieve_batch, name="retrieval")
+query_flight = SingleFlight()
+
+# Per-request spans include time spent waiting for the batch to fill
+async def aembed_question(query: str):
+    with span("embedding"):
+        vector = await embeddings.acached(query)
+        if vector is not None:
+            return vector
+        if COALESCE_ENABLED:
+            return await embedding_batcher.submit(query)
+        return await embedding_upstream.call(lambda: embeddings.aembed_query(query))
+
+async def aretrieve_context(inputs: dict):
+    with span("retrieval"):
+        if COALESCE_ENABLED:
+            return await retrieval_batcher.submit(inputs["query_vector"])
+        return await retrieval_upstream.call(lambda: _in_retrieval_pool(retrieve_context, inputs))
+
+def _init_embeddings():
+    global embeddings
+    if not OPENAI_API_KEY:
+        logger.error("API key is missing for OpenAI.")
+        raise RuntimeError("API key for OpenAI is required.")
+    if embeddings is None:
+        embeddings = CachedEmbeddings(OpenAIEmbeddings(
+            api_key=OPENAI_API_KEY, request_timeout=EMBEDDING_TIMEOUT, max_retries=OPENAI_MAX_RETRIES,
+        ))
+
+def _init_vectorstore():
+    global vectorstore
+    if vectorstore is not None:
+        return
+    if RETRIEVER_BACKEND == "local":
+        vectorstore = LocalVectorIndex()
+        return
+    if not PINECONE_API_KEY:
+        logger.error("API key is missing for Pinecone.")
+        raise RuntimeError("API key for Pinecone is required.")
+    pc = PineconeClient(api_key=PINECONE_API_KEY)
+    if index_name not in pc.list_indexes().names():
+        logger.error(f"Pinecone index '{index_name}' not found.")
+        raise RuntimeError(f"Pinecone index '{index_name}' is missing. Please create it.")
+    vectorstore = Pinecone.from_existing_index(index_name=index_name, embedding=embeddings)
+
+def build_retrieval_chain(llm):
+    return (
+        {
+            "context": RunnableLambda(timed_retrieve_context, afunc=aretrieve_context),
+            "question": itemgetter("question"),
+            "chat_history": itemgetter("chat_history"),
+        }
+        | RunnableLambda(render_prompt)
+        | llm
+        | StrOutputParser()
+    )
+
+def init_rag():
+    global chat_model, retrieval_chain
+    if retrieval_chain is not None:
+        return
+    with _init_lock:
+        if retrieval_chain is not None:
+            return
+        _init_embeddings()
+        _init_vectorstore()
+        chat_model = OpenAI(
+            api_key=OPENAI_API_KEY, model_name='gpt-4o-mini',
+            request_timeout=LLM_TIMEOUT, max_retries=OPENAI_MAX_RETRIES,
+        )
+        retrieval_chain = build_retrieval_chain(chat_model)
+        logger.info("RAG stack initialized")
+
+async def ainit_rag():
+    if retrieval_chain is None:
+        await asyncio.to_thread(init_rag)
+
+# Warm-up checks run concurrently at app startup; each raises if its dependency is unusable
+async def check_vectorstore():
+    await asyncio.to_thread(init_rag)
+
+async def check_openai():
+    _init_embeddings()
+    # Goes to the inner embedder so the probe really reaches OpenAI
+    await embeddings.inner.aembed_query("readiness probe")
+
+async def check_tokenizer():
+    await asyncio.to_thread(prompt_builder.warm)
+
+def _cache_stats():
+    stats = {"answer": answer_cache.stats()}
+    if embeddings is not None:
+        stats["embedding"] = embeddings.stats()
+    return stats
+
+# Cache counters are read at scrape time rather than updated per request
+gauge("rag_cache_hits", "Cache hits since process start",
+      lambda: {k: v["hits"] for k, v in _cache_stats().items()}, labels=("cache",))
+gauge("rag_cache_misses", "Cache misses since process start",
+      lambda: {k: v["misses"] for k, v in _cache_stats().items()}, labels=("cache",))
+gauge("rag_cache_hit_rate", "Cache hit rate since process start",
+      lambda: {k: v["hit_rate"] for k, v in _cache_stats().items()}, labels=("cache",))
+
+# Passed to every chain run so the LLM call is timed and its token usage counted
+CHAIN_CONFIG = {"callbacks": [llm_timing]}
 
 router = APIRouter()
 
-def process_query(query: str):
+def _cacheable(turns) -> bool:
+    # Answers are keyed on the question alone, so follow-ups that depend on chat history are never cached
+    return ANSWER_CACHE_ENABLED and not turns
+
+def process_query(query: str, session_id: str = None):
+    try:
+        logger.info("Processing query with RAG system...")
+        init_rag()
+        with span("embedding"):
+            query_vector = embeddings.embed_query(query)
+        turns = memory.turns(session_id)
+        with span("answer_cache"):
+            response = answer_cache.get(query_vector) if _cacheable(turns) else None
+        if response is None:
+            response = retrieval_chain.invoke({
+                "question": query,
+                "query_vector": query_vector,
+                "chat_history": turns,
+            }, config=CHAIN_CONFIG)
+            if _cacheable(turns):
+                answer_cache.put(query_vector, response)
+        memory.save(session_id, query, response)
+        return response
+    except Exception as e:
+        logger.error(f"Error processing query: {e}")
+        raise HTTPException(status_code=500, detail="Error processing query")
+
+# Prepended to fallback answers: at the looser threshold the cached answer may be
+# about a neighbouring topic, so the reader must be told it is not a fresh answer
+DEGRADED_NOTICE = (
+    "The answer service is temporarily unavailable. The following is a saved answer to a similar "
+    "question and may not match yours exactly.\n\n"
+)
+
+async def _degraded_answer(query: str, query_vector, turns, error):
+    # Closest cached answer, accepted at a looser threshold, while generation is failing
+    if not _cacheable(turns):
+        return None
+    answer = await answer_cache.aget(query_vector, cache_key(query), threshold=FALLBACK_CACHE_THRESHOLD)
+    if answer is None:
+        return None
+    logger.warning(f"Serving cached answer while generation is unavailable: {error}")
+    return DEGRADED_NOTICE + answer
+
+def _unavailable():
+    return HTTPException(
+        status_code=503,
+        detail="The answer service is temporarily degraded, please retry shortly",
+        headers={"Retry-After": "10"},
+    )
+
+async def _answer(query: str, turns):
+    query_vector = await aembed_question(query)
+    with span("answer_cache"):
+        response = await answer_cache.aget(query_vector, cache_key(query)) if _cacheable(turns) else None
+    if response is not None:
+        logger.info("Answer served from semantic cache")
+        return response
+    try:
+        response = await llm_upstream.call(lambda: retrieval_chain.ainvoke({
+            "question": query,
+            "query_vector": query_vector,
+            "chat_history": turns,
+        }, config=CHAIN_CONFIG))
+    except Exception as e:
+        fallback = await _degraded_answer(query, query_vector, turns, e)
+        if fallback is None:
+            raise
+        return fallback
+    if _cacheable(turns):
+        with span("answer_cache"):
+            await answer_cache.aput(query_vector, response, cache_key(query))
+    return response
+
+# Async variant used by the API so upstream calls never block the event loop.
+# Identical in-flight questions (same normalized text and history) share one pipeline run.
+async def aprocess_query(query: str, session_id: str = None):
     try:
         logger.info("Processing query with RAG system...")
-        response = retrieval_chain.invoke({"question": query})
-        memory.save_context({"question": query}, {"response": response})
+        await ainit_rag()
+        with budget():
+            with span("history"):
+                await memory.aload(session_id)
+            turns = memory.turns(session_id)
+            if COALESCE_ENABLED:
+                flight_key = (cache_key(query), hash(tuple(turns)))
+                response = await query_flight.do(flight_key, lambda: _answer(query, turns))
+            else:
+                response = await _answer(query, turns)
+        memory.save(session_id, query, response)
         return response
+    except UpstreamUnavailable as e:
+        logger.error(f"Error processing query: {e}")
+        raise _unavailable()
     except Exception as e:
         logger.error(f"Error processing query: {e}")
         raise HTTPException(status_code=500, detail="Error processing query")
 
+# Streaming variant: yields answer chunks as they arrive. Memory and the answer
+# cache are only updated once the full answer has been generated; closing the
+# generator early (client disconnect) closes the upstream stream with it.
+async def astream_query(query: str, session_id: str = None):
+    logger.info("Streaming query with RAG system...")
+    await ainit_rag()
+    # The budget covers the steps before the first token; the stream itself is bounded by LLM_TIMEOUT
+    with budget():
+        with span("history"):
+            await memory.aload(session_id)
+        turns = memory.turns(session_id)
+        query_vector = await aembed_question(query)
+        with span("answer_cache"):
+            cached = await answer_cache.aget(query_vector, cache_key(query)) if _cacheable(turns) else None
+    if cached is not None:
+        logger.info("Answer served from semantic cache")
+        yield cached
+        memory.save(session_id, query, cached)
+        return
+
+    chunks = []
+    stream = llm_upstream.stream(retrieval_chain.astream({
+        "question": query,
+        "query_vector": query_vector,
+        "chat_history": turns,
+    }, config=CHAIN_CONFIG))
+    try:
+        async for chunk in stream:
+            chunks.append(chunk)
+            yield chunk
+    except Exception as e:
+        # Before the first chunk a close cached answer beats an error
+        fallback = None if chunks else await _degraded_answer(query, query_vector, turns, e)
+        if fallback is None:
+            raise
+        yield fallback
+        memory.save(session_id, query, fallback)
+        return
+    finally:
+        await stream.aclose()
+
+    response = "".join(chunks)
+    if _cacheable(turns):
+        with span("answer_cache"):
+            await answer_cache.aput(query_vector, response, cache_key(query))
+    memory.save(session_id, query, response)
+
 @router.post("/query")
 async def query_endpoint(query: str):
     try:
-        response = process_query(query)
+        response = await aprocess_query(query)
         return {"response": response}
     except HTTPException as e:
         logger.error(f"HTTP error in query endpoint: {e.detail}")
@@ -0,0 +1,9 @@
+import os
+
+# Daily query limits
+SUBSCRIBER_QUERY_LIMIT = int(os.getenv("SUBSCRIBER_QUERY_LIMIT", "70"))
+FREE_QUERY_LIMIT = int(os.getenv("FREE_QUERY_LIMIT", "3"))
+
+
+def query_limit(is_subscriber: bool) -> int:
+    return SUBSCRIBER_QUERY_LIMIT if is_subscriber else FREE_QUERY_LIMIT
@@ -0,0 +1,180 @@
+import os
+import math
+import time
+import logging
+from collections import OrderedDict
+from urllib.parse import parse_qs
+from starlette.responses import JSONResponse
+from metrics import counter
+from sessions import verify_token
+
+try:
+    import redis.asyncio as redis
+except ImportError:  # optional shared backend
+    redis = None
+
+logger = logging.getLogger(__name__)
+
+# Token buckets per user and per client IP, checked before any database or model
+# work. Each bucket holds up to BURST requests and refills at RATE per second.
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "true").lower() == "true"
+RATE_LIMIT_USER_RATE = float(os.getenv("RATE_LIMIT_USER_RATE", "0.5"))
+RATE_LIMIT_USER_BURST = float(os.getenv("RATE_LIMIT_USER_BURST", "10"))
+RATE_LIMIT_IP_RATE = float(os.getenv("RATE_LIMIT_IP_RATE", "2"))
+RATE_LIMIT_IP_BURST = float(os.getenv("RATE_LIMIT_IP_BURST", "30"))
+RATE_LIMIT_MAX_KEYS = int(os.getenv("RATE_LIMIT_MAX_KEYS", "100000"))
+RATE_LIMIT_PATHS = {
+    p.strip() for p in os.getenv(
+        "RATE_LIMIT_PATHS", "/query,/query/stream,/jobs,/payment/create-checkout-session"
+    ).split(",") if p.strip()
+}
+# Only behind a proxy that sets X-Forwarded-For; otherwise clients could pick their own IP
+RATE_LIMIT_TRUST_FORWARDED = os.getenv("RATE_LIMIT_TRUST_FORWARDED", "false").lower() == "true"
+# Share buckets across workers through Redis; unset keeps them per process
+RATE_LIMIT_REDIS_URL = os.getenv("RATE_LIMIT_REDIS_URL")
+
+rate_limited = counter("rate_limited_requests_total", "Requests rejected by the rate limiter", labels=("bucket",))
+
+
+class TokenBuckets:
+    # key -> (tokens, updated) in least-recently-used order. A bucket idle long
+    # enough to refill is indistinguishable from a new one, so it is dropped.
+    def __init__(self, rate: float, burst: float, max_keys: int = RATE_LIMIT_MAX_KEYS):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+
+    def acquire(self, key: str, now: float = None) -> float:
+        # Takes a token and returns 0, or returns the seconds until one is available
+        now = time.monotonic() if now is None else now
+        entry = self._buckets.get(key)
+        tokens = self.burst if entry is None else min(self.burst, entry[0] + (now - entry[1]) * self.rate)
+        if tokens < 1:
+            return (1 - tokens) / self.rate
+        self._buckets[key] = (tokens - 1, now)
+        self._buckets.move_to_end(key)
+        self._evict(now)
+        return 0.0
+
+    def _evict(self, now: float):
+        refill = self.burst / self.rate
+        while self._buckets:
+            key, (_, updated) = next(iter(self._buckets.items()))
+            if now - updated < refill and len(self._buckets) <= self.max_keys:
+                break
+            self._buckets.popitem(last=False)
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+# Same bucket as TokenBuckets.acquire, atomic in Redis and timed by the Redis clock
+_REDIS_ACQUIRE = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(state[1]) or burst
+local updated = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+if tokens < 1 then
+  return tostring((1 - tokens) / rate)
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens - 1, 'updated', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return '0'
+"""
+
+
+class RedisTokenBuckets:
+    def __init__(self, client, prefix: str, rate: float, burst: float, fallback: TokenBuckets):
+        self.prefix = prefix
+        self.rate = rate
+        self.burst = burst
+        self.fallback = fallback
+        self._script = client.register_script(_REDIS_ACQUIRE)
+
+    async def acquire(self, key: str) -> float:
+        try:
+            return float(await self._script(keys=[f"{self.prefix}:{key}"], args=[self.rate, self.burst]))
+        except Exception as e:
+            # Keep limiting per process rather than failing requests
+            logger.error(f"Error reaching rate limit backend: {e}")
+            return self.fallback.acquire(key)
+
+
+class RateLimiter:
+    def __init__(self, redis_url: str = RATE_LIMIT_REDIS_URL):
+        self.user = TokenBuckets(RATE_LIMIT_USER_RATE, RATE_LIMIT_USER_BURST)
+        self.ip = TokenBuckets(RATE_LIMIT_IP_RATE, RATE_LIMIT_IP_BURST)
+        self._shared = None
+        if redis_url and redis is None:
+            logger.warning("RATE_LIMIT_REDIS_URL is set but redis is not installed; limiting per process")
+        elif redis_url:
+            client = redis.from_url(redis_url)
+            self._shared = {
+                "ip": RedisTokenBuckets(client, "ratelimit:ip", RATE_LIMIT_IP_RATE, RATE_LIMIT_IP_BURST, self.ip),
+                "user": RedisTokenBuckets(client, "ratelimit:user", RATE_LIMIT_USER_RATE, RATE_LIMIT_USER_BURST,
+                                          self.user),
+            }
+
+    async def acquire(self, bucket: str, key: str) -> float:
+        if self._shared is not None:
+            return await self._shared[bucket].acquire(key)
+        return getattr(self, bucket).acquire(key)
+
+
+def _client_ip(scope) -> str:
+    if RATE_LIMIT_TRUST_FORWARDED:
+        for name, value in scope["headers"]:
+            if name == b"x-forwarded-for":
+                return value.decode("latin-1").split(",")[0].strip()
+    client = scope.get("client")
+    return client[0] if client else "unknown"
+
+
+def _user_key(scope):
+    # A valid session token identifies the user without a lookup; otherwise the
+    # user_email parameter the endpoint will look up is the key
+    for name, value in scope["headers"]:
+        if name == b"authorization":
+            scheme, _, token = value.decode("latin-1").partition(" ")
+            claims = verify_token(token.strip()) if scheme.lower() == "bearer" else None
+            return f"user:{claims['sub']}" if claims else None
+    emails = parse_qs(scope.get("query_string", b"").decode("latin-1")).get("user_email")
+    return f"email:{emails[0].strip().lower()}" if emails else None
+
+
+class RateLimitMiddleware:
+    # Plain ASGI middleware so rejected requests never reach routing, validation or Mongo
+    def __init__(self, app, limiter: RateLimiter = None, paths=RATE_LIMIT_PATHS):
+        self.app = app
+        self.limiter = limiter or RateLimiter()
+        self.paths = set(paths)
+
+    async def __call__(self, scope, receive, send):
+        if (not RATE_LIMIT_ENABLED or scope["type"] != "http" or scope["method"] != "POST"
+                or scope["path"] not in self.paths):
+            await self.app(scope, receive, send)
+            return
+
+        # The IP bucket goes first, so a rejected IP never spends the user's tokens
+        wait = await self.limiter.acquire("ip", _client_ip(scope))
+        bucket = "ip"
+        if not wait:
+            user_key = _user_key(scope)
+            if user_key is not None:
+                wait = await self.limiter.acquire("user", user_key)
+                bucket = "user"
+        if wait:
+            rate_limited.inc(1, bucket)
+            response = JSONResponse(
+                {"detail": "Too many requests, please slow down"},
+                status_code=429,
+                headers={"Retry-After": str(max(1, math.ceil(wait)))},
+            )
+            await response(scope, receive, send)
+            return
+        await self.app(scope, receive, send)
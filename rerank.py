@@ -0,0 +1,90 @@
+import os
+import logging
+import numpy as np
+from langchain_core.documents import Document
+from local_index import normalize_rows
+
+logger = logging.getLogger(__name__)
+
+# Post-retrieval re-ranking: over-fetch RERANK_FETCH_K candidates with their
+# vectors, drop chunks nearly identical to one already chosen and pick the final
+# k by maximal marginal relevance. RERANK_LAMBDA weighs relevance (1.0) against
+# diversity (0.0).
+RERANK_ENABLED = os.getenv("RERANK_ENABLED", "true").lower() == "true"
+RERANK_FETCH_K = int(os.getenv("RERANK_FETCH_K", "20"))
+RERANK_LAMBDA = float(os.getenv("RERANK_LAMBDA", "0.7"))
+RERANK_DUPLICATE_THRESHOLD = float(os.getenv("RERANK_DUPLICATE_THRESHOLD", "0.95"))
+
+
+def mmr_batch(queries, candidates, mask, k: int, lambda_mult: float = RERANK_LAMBDA,
+              duplicate_threshold: float = RERANK_DUPLICATE_THRESHOLD):
+    # queries (B, d), candidates (B, n, d), mask (B, n) marks real candidates.
+    # Returns (B, k) candidate indices in pick order, padded with -1. All pairwise
+    # similarities come from one batched matrix product; the loop runs k times
+    # over whole (B, n) arrays.
+    queries = normalize_rows(queries)
+    candidates = normalize_rows(candidates)
+    relevance = np.einsum("bnd,bd->bn", candidates, queries)
+    similarity = candidates @ candidates.transpose(0, 2, 1)
+    batch, n = relevance.shape
+    rows = np.arange(batch)
+    columns = np.arange(n)
+    available = np.asarray(mask, dtype=bool).copy()
+    redundancy = None
+    selected = np.full((batch, k), -1, dtype=np.int64)
+    for step in range(min(k, n)):
+        score = relevance if redundancy is None else lambda_mult * relevance - (1 - lambda_mult) * redundancy
+        score = np.where(available, score, -np.inf)
+        best = score.argmax(axis=1)
+        valid = np.isfinite(score[rows, best])
+        if not valid.any():
+            break
+        selected[:, step] = np.where(valid, best, -1)
+        best_similarity = similarity[rows, best]
+        # The pick and every chunk nearly identical to it leave the pool
+        drop = (best_similarity >= duplicate_threshold) | (columns == best[:, None])
+        available &= ~(drop & valid[:, None])
+        redundancy = best_similarity if redundancy is None else np.maximum(redundancy, best_similarity)
+    return selected
+
+
+def mmr_select(query, vectors, k: int, **kwargs):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if vectors.ndim != 2 or not len(vectors):
+        return []
+    picks = mmr_batch(np.atleast_2d(query), vectors[None], np.ones((1, len(vectors)), dtype=bool), k, **kwargs)[0]
+    return [int(i) for i in picks if i >= 0]
+
+
+def fetch_candidates(vectorstore, query_vector, fetch_k: int, include_values: bool = True, timeout: float = None):
+    # Returns (documents, vectors); vectors is None when the store cannot return them
+    if hasattr(vectorstore, "search_with_vectors"):
+        return vectorstore.search_with_vectors(query_vector, fetch_k)
+    index = getattr(vectorstore, "_index", None)
+    if index is not None:
+        # LangChain's Pinecone store drops the vectors and takes no request
+        # timeout, so query its index directly
+        response = index.query(
+            vector=[float(x) for x in query_vector],
+            top_k=fetch_k,
+            include_values=include_values,
+            include_metadata=True,
+            namespace=getattr(vectorstore, "_namespace", None),
+            _request_timeout=timeout,
+        )
+        documents, vectors = [], []
+        for match in response["matches"]:
+            metadata = dict(match.get("metadata") or {})
+            text = metadata.pop(vectorstore._text_key, "")
+            documents.append(Document(page_content=text, metadata=metadata))
+            vectors.append(match.get("values"))
+        return documents, np.asarray(vectors, dtype=np.float32) if include_values else None
+    documents = vectorstore.similarity_search_by_vector(query_vector, k=fetch_k)
+    return documents, None
+
+
+def rerank(vectorstore, query_vector, k: int, fetch_k: int = RERANK_FETCH_K, timeout: float = None):
+    documents, vectors = fetch_candidates(vectorstore, query_vector, max(fetch_k, k), timeout=timeout)
+    if vectors is None:
+        return documents[:k]
+    return [documents[i] for i in mmr_select(query_vector, vectors, k)]
@@ -0,0 +1,254 @@
+import os
+import time
+import asyncio
+import logging
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+import numpy as np
+from metrics import counter, gauge
+
+logger = logging.getLogger(__name__)
+
+# Every query gets REQUEST_BUDGET seconds end to end. Each upstream call waits
+# for at most its own timeout or whatever is left of the budget, whichever is less.
+REQUEST_BUDGET = float(os.getenv("REQUEST_BUDGET", "60"))
+EMBEDDING_TIMEOUT = float(os.getenv("EMBEDDING_TIMEOUT", "5"))
+RETRIEVAL_TIMEOUT = float(os.getenv("RETRIEVAL_TIMEOUT", "5"))
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "55"))
+
+# A second attempt starts once the first has run longer than this percentile of
+# recent latencies (never sooner than HEDGE_MIN_DELAY_MS)
+HEDGE_ENABLED = os.getenv("HEDGE_ENABLED", "true").lower() == "true"
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "95"))
+HEDGE_MIN_DELAY_MS = float(os.getenv("HEDGE_MIN_DELAY_MS", "50"))
+HEDGE_MAX_ATTEMPTS = int(os.getenv("HEDGE_MAX_ATTEMPTS", "2"))
+
+# After this many consecutive failures an upstream is skipped for BREAKER_RESET_SECONDS
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("BREAKER_FAILURE_THRESHOLD", "5"))
+BREAKER_RESET_SECONDS = float(os.getenv("BREAKER_RESET_SECONDS", "30"))
+
+# While the LLM is unavailable, cached answers this similar to the question are served
+# instead, prefixed with a notice that they are not a fresh answer
+FALLBACK_CACHE_THRESHOLD = float(os.getenv("FALLBACK_CACHE_THRESHOLD", "0.88"))
+
+_deadline = ContextVar("request_deadline", default=None)
+
+hedged_requests = counter("rag_hedged_requests_total", "Hedge attempts started per upstream", labels=("upstream",))
+upstream_failures = counter("rag_upstream_failures_total", "Failed or timed-out upstream calls", labels=("upstream",))
+
+
+class UpstreamUnavailable(Exception):
+    # The upstream is failing fast (circuit open) or did not answer in time
+    def __init__(self, upstream: str, reason: str):
+        super().__init__(f"{upstream} unavailable: {reason}")
+        self.upstream = upstream
+        self.reason = reason
+
+
+@contextmanager
+def budget(seconds: float = REQUEST_BUDGET):
+    # A nested budget never extends the enclosing one
+    deadline = time.monotonic() + seconds
+    current = _deadline.get()
+    token = _deadline.set(deadline if current is None else min(current, deadline))
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def remaining(limit: float):
+    deadline = _deadline.get()
+    if deadline is None:
+        return limit
+    return min(limit, deadline - time.monotonic())
+
+
+class LatencyTracker:
+    def __init__(self, window: int = 500):
+        self._samples = deque(maxlen=window)
+
+    def record(self, seconds: float):
+        self._samples.append(seconds)
+
+    def percentile(self, p: float):
+        if len(self._samples) < 20:
+            return None
+        return float(np.percentile(np.fromiter(self._samples, dtype=np.float64), p))
+
+
+class CircuitBreaker:
+    # closed -> open after `failure_threshold` consecutive failures; open -> half
+    # open after `reset_timeout`, where one trial call decides whether to close again
+    def __init__(self, name: str, failure_threshold: int = BREAKER_FAILURE_THRESHOLD,
+                 reset_timeout: float = BREAKER_RESET_SECONDS):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._trial_started = None
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half_open"
+        return "open"
+
+    def allow(self):
+        state = self.state
+        if state == "closed":
+            return True
+        # A trial that never reported back (e.g. cancelled) is replaced after another reset_timeout
+        now = time.monotonic()
+        if state == "half_open" and (self._trial_started is None or now - self._trial_started >= self.reset_timeout):
+            self._trial_started = now
+            return True
+        return False
+
+    def record_success(self):
+        if self.opened_at is not None:
+            logger.info(f"Circuit for {self.name} closed")
+        self.failures = 0
+        self.opened_at = None
+        self._trial_started = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self._trial_started is not None or self.failures >= self.failure_threshold:
+            if self.opened_at is None:
+                logger.warning(f"Circuit for {self.name} opened after {self.failures} failures")
+            self.opened_at = time.monotonic()
+            self._trial_started = None
+
+
+class Upstream:
+    # Deadline, optional hedging and a circuit breaker around one upstream dependency
+    def __init__(self, name: str, timeout: float, hedge: bool = False):
+        self.name = name
+        self.timeout = timeout
+        self.hedge = hedge and HEDGE_ENABLED and HEDGE_MAX_ATTEMPTS > 1
+        self.latency = {}  # call shape -> LatencyTracker
+        self.breaker = CircuitBreaker(name)
+
+    def _check(self):
+        if not self.breaker.allow():
+            raise UpstreamUnavailable(self.name, "circuit open")
+        timeout = remaining(self.timeout)
+        if timeout <= 0:
+            raise UpstreamUnavailable(self.name, "request budget exhausted")
+        return timeout
+
+    def _failed(self, error):
+        # Errors raised by a nested upstream (e.g. retrieval inside the chain) count against that one only
+        if isinstance(error, UpstreamUnavailable):
+            if error.upstream != self.name:
+                return
+        elif getattr(error, "_failed_upstream", self.name) != self.name:
+            return
+        else:
+            error._failed_upstream = self.name
+        upstream_failures.inc(1, self.name)
+        self.breaker.record_failure()
+
+    def tracker(self, shape: str):
+        return self.latency.setdefault(shape, LatencyTracker())
+
+    async def call(self, factory, shape: str = "single", hedge: bool = True):
+        # `factory` returns a fresh awaitable per attempt. Latencies are kept per call
+        # shape (e.g. one query vs a micro-batch) so a hedge delay is only ever derived
+        # from calls like the one being hedged. Batched calls pass hedge=False: a hedge
+        # would resend every item in the batch.
+        timeout = self._check()
+        tracker = self.tracker(shape)
+        try:
+            attempt = self._hedged(factory, tracker) if self.hedge and hedge else self._timed(factory, tracker)
+            result = await asyncio.wait_for(attempt, timeout)
+        except asyncio.TimeoutError:
+            error = UpstreamUnavailable(self.name, f"no answer within {timeout:.1f}s")
+            self._failed(error)
+            raise error
+        except Exception as e:
+            self._failed(e)
+            raise
+        self.breaker.record_success()
+        return result
+
+    async def stream(self, chunks):
+        # Bounds a whole async iterator (e.g. an LLM token stream) by the remaining budget
+        try:
+            timeout = self._check()
+        except UpstreamUnavailable:
+            await chunks.aclose()
+            raise
+        deadline = asyncio.get_running_loop().time() + timeout
+        iterator = chunks.__aiter__()
+        try:
+            while True:
+                # The chunk is awaited in this task (wait_for would run it in another one),
+                # so a cancelled consumer never leaves the generator running while it is closed
+                try:
+                    async with asyncio.timeout_at(deadline):
+                        chunk = await iterator.__anext__()
+                except StopAsyncIteration:
+                    break
+                yield chunk
+        except asyncio.TimeoutError:
+            error = UpstreamUnavailable(self.name, "stream stalled past the deadline")
+            self._failed(error)
+            raise error
+        except Exception as e:
+            self._failed(e)
+            raise
+        finally:
+            await chunks.aclose()
+        self.breaker.record_success()
+
+    async def _timed(self, factory, tracker: LatencyTracker):
+        started = time.monotonic()
+        result = await factory()
+        tracker.record(time.monotonic() - started)
+        return result
+
+    def hedge_delay(self, tracker: LatencyTracker):
+        # None (no hedging) until there are enough samples for a percentile
+        p = tracker.percentile(HEDGE_PERCENTILE)
+        return None if p is None else max(HEDGE_MIN_DELAY_MS / 1000, p)
+
+    async def _hedged(self, factory, tracker: LatencyTracker):
+        # First successful attempt wins; the losers are cancelled
+        attempts = [asyncio.ensure_future(self._timed(factory, tracker))]
+        started = 1
+        error = None
+        try:
+            while attempts:
+                delay = self.hedge_delay(tracker) if started < HEDGE_MAX_ATTEMPTS else None
+                done, _ = await asyncio.wait(attempts, timeout=delay, return_when=asyncio.FIRST_COMPLETED)
+                for attempt in done:
+                    attempts.remove(attempt)
+                    if attempt.exception() is None:
+                        return attempt.result()
+                    error = attempt.exception()
+                # Slow or failed: start another attempt while any are left
+                if started < HEDGE_MAX_ATTEMPTS:
+                    hedged_requests.inc(1, self.name)
+                    attempts.append(asyncio.ensure_future(self._timed(factory, tracker)))
+                    started += 1
+            raise error
+        finally:
+            for attempt in attempts:
+                attempt.cancel()
+
+
+embedding_upstream = Upstream("embedding", EMBEDDING_TIMEOUT, hedge=True)
+retrieval_upstream = Upstream("retrieval", RETRIEVAL_TIMEOUT, hedge=True)
+llm_upstream = Upstream("llm", LLM_TIMEOUT)
+
+gauge(
+    "rag_circuit_open", "1 while an upstream's circuit breaker is rejecting calls",
+    lambda: {u.name: int(u.breaker.state == "open") for u in (embedding_upstream, retrieval_upstream, llm_upstream)},
+    labels=("upstream",),
+)
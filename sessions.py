@@ -0,0 +1,146 @@
+import os
+import hmac
+import json
+import time
+import base64
+import asyncio
+import hashlib
+import logging
+import secrets
+from datetime import datetime, timedelta, timezone
+from fastapi import HTTPException, status
+from pymongo import errors
+from database import User, SessionRevocations
+
+logger = logging.getLogger(__name__)
+
+# Session tokens are issued at login and verified locally with HMAC-SHA256, so the
+# hot path needs neither a network call nor a user-document read. They carry the
+# Google user id and subscription tier; subscription changes applied from the
+# Stripe webhook revoke a user's older tokens.
+SESSION_TOKEN_SECRET = os.getenv("SESSION_TOKEN_SECRET")
+SESSION_TOKEN_TTL = int(os.getenv("SESSION_TOKEN_TTL", "3600"))
+SESSION_REVOCATION_POLL_INTERVAL = float(os.getenv("SESSION_REVOCATION_POLL_INTERVAL", "5"))
+
+if SESSION_TOKEN_SECRET:
+    _secret = SESSION_TOKEN_SECRET.encode("utf-8")
+else:
+    # Tokens then only verify on the worker that issued them and die with it, so
+    # check_secret keeps /readyz failing; this only serves local development
+    logger.warning("SESSION_TOKEN_SECRET is not set; using a per-process secret")
+    _secret = secrets.token_bytes(32)
+
+# google_user_id -> revocation time, mirrored from the session_revocations collection
+_revoked = {}
+_last_poll = 0.0
+
+
+async def check_secret():
+    # Readiness check
+    if not SESSION_TOKEN_SECRET:
+        raise RuntimeError("SESSION_TOKEN_SECRET is not set; session tokens would not verify across workers or restarts")
+
+
+def _encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+
+def _decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+def _sign(payload: str) -> str:
+    return _encode(hmac.new(_secret, payload.encode("ascii"), hashlib.sha256).digest())
+
+
+def issue_token(user: dict) -> str:
+    now = time.time()
+    claims = {
+        "sub": user["google_user_id"],
+        "tier": "subscriber" if user.get("is_subscriber") else "free",
+        "iat": now,
+        "exp": int(now) + SESSION_TOKEN_TTL,
+    }
+    payload = _encode(json.dumps(claims, separators=(",", ":")).encode("utf-8"))
+    return f"{payload}.{_sign(payload)}"
+
+
+def verify_token(token: str):
+    # Returns the claims, or None for a malformed, forged, expired or revoked token
+    # ValueError covers UnicodeError and binascii.Error; compare_digest raises
+    # TypeError for non-ASCII strings
+    try:
+        payload, signature = token.split(".")
+        if not hmac.compare_digest(signature, _sign(payload)):
+            return None
+        claims = json.loads(_decode(payload))
+    except (ValueError, TypeError):
+        return None
+    if claims["exp"] < time.time():
+        return None
+    if claims["iat"] < _revoked.get(claims["sub"], 0.0):
+        return None
+    return claims
+
+
+async def revoke(google_user_ids):
+    google_user_ids = list(google_user_ids)
+    if not google_user_ids:
+        return
+    now = time.time()
+    for gid in google_user_ids:
+        _revoked[gid] = now
+    expires_at = datetime.now(timezone.utc) + timedelta(seconds=SESSION_TOKEN_TTL)
+    await SessionRevocations.revoke(google_user_ids, now, expires_at)
+    logger.info(f"Revoked sessions for {len(google_user_ids)} users")
+
+
+async def poll_revocations():
+    global _last_poll
+    # Overlap polls a little to tolerate clock skew between workers; applying an entry twice is harmless
+    docs = await SessionRevocations.since(_last_poll - SESSION_REVOCATION_POLL_INTERVAL)
+    for doc in docs:
+        _revoked[doc["_id"]] = max(_revoked.get(doc["_id"], 0.0), doc["revoked_at"])
+        _last_poll = max(_last_poll, doc["revoked_at"])
+    # Entries older than the token lifetime cannot reject anything any more
+    cutoff = time.time() - SESSION_TOKEN_TTL
+    for gid in [gid for gid, revoked_at in _revoked.items() if revoked_at < cutoff]:
+        del _revoked[gid]
+
+
+async def run_revocation_poller(interval: float = SESSION_REVOCATION_POLL_INTERVAL):
+    while True:
+        try:
+            await poll_revocations()
+        except errors.PyMongoError as e:
+            logger.error(f"Error polling session revocations: {e}")
+        await asyncio.sleep(interval)
+
+
+async def resolve_user(authorization: str = None, user_email: str = None):
+    # Bearer session token first; a raw user_email still works for older clients
+    # at the cost of one user-document read
+    if authorization:
+        scheme, _, token = authorization.partition(" ")
+        claims = verify_token(token.strip()) if scheme.lower() == "bearer" else None
+        if claims is None:
+            raise HTTPException(
+                status_code=status.HTTP_401_UNAUTHORIZED,
+                detail="Invalid or expired session token",
+                headers={"WWW-Authenticate": "Bearer"},
+            )
+        return {"google_user_id": claims["sub"], "is_subscriber": claims["tier"] == "subscriber"}
+
+    if not user_email:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Authentication required",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    user = await User.get_user_by_email(user_email, {"_id": 0, "google_user_id": 1, "is_subscriber": 1})
+    if not user:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="User not found"
+        )
+    return user
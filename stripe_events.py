@@ -0,0 +1,143 @@
+import os
+import asyncio
+import argparse
+import logging
+from datetime import datetime, timezone
+from pymongo import UpdateOne, errors
+from database import StripeEvents, User
+import sessions
+
+# Applies Stripe events recorded by the webhook to user documents in the background.
+# Replay handled events from the log with:
+#   python stripe_events.py replay --since 2024-01-01T00:00:00+00:00 --type customer.subscription.deleted
+
+logger = logging.getLogger(__name__)
+
+STRIPE_EVENT_BATCH_SIZE = int(os.getenv("STRIPE_EVENT_BATCH_SIZE", "100"))
+STRIPE_EVENT_BATCH_WAIT_MS = int(os.getenv("STRIPE_EVENT_BATCH_WAIT_MS", "200"))
+# Events recorded by other workers are picked up on this interval
+STRIPE_EVENT_POLL_INTERVAL = float(os.getenv("STRIPE_EVENT_POLL_INTERVAL", "5"))
+
+_wakeup = asyncio.Event()
+
+
+def notify():
+    # Called by the webhook after recording an event so this worker applies it without waiting for the poll
+    _wakeup.set()
+
+
+def subscription_update(event: dict):
+    # Translates one logged event into a user update, or None when there is nothing to apply
+    obj = event["object"]
+    created = event["created"]
+    event_type = event["type"]
+    if event_type == "checkout.session.completed":
+        google_user_id = obj.get("client_reference_id")
+        if not google_user_id:
+            return None
+        match = {"google_user_id": google_user_id}
+        fields = {"is_subscriber": True, "subscription_status": "active"}
+        if obj.get("customer"):
+            fields["stripe_customer_id"] = obj["customer"]
+        if obj.get("subscription"):
+            fields["stripe_subscription_id"] = obj["subscription"]
+    elif event_type in ("customer.subscription.deleted", "invoice.payment_failed", "invoice.paid"):
+        if not obj.get("customer"):
+            return None
+        match = {"stripe_customer_id": obj["customer"]}
+        if event_type == "customer.subscription.deleted":
+            fields = {"is_subscriber": False, "subscription_status": "canceled"}
+        elif event_type == "invoice.payment_failed":
+            # Stripe keeps retrying the charge and sends customer.subscription.deleted
+            # once it gives up, so access is only flagged here, not revoked
+            fields = {"subscription_status": "past_due", "payment_failed_at": created}
+        else:
+            fields = {"is_subscriber": True, "subscription_status": "active"}
+    else:
+        return None
+
+    # Stripe does not guarantee delivery order and replays resend old events;
+    # a change only lands if it is at least as new as the last one applied
+    fields["subscription_event_created"] = created
+    newer = {"$or": [
+        {"subscription_event_created": {"$exists": False}},
+        {"subscription_event_created": {"$lte": created}},
+    ]}
+    return UpdateOne({**match, **newer}, {"$set": fields})
+
+
+async def process_pending(batch_size: int = STRIPE_EVENT_BATCH_SIZE):
+    # Workers may pick up the same pending batch; every update is idempotent, so that is harmless
+    events = await StripeEvents.pending(batch_size)
+    if not events:
+        return 0
+    updates, processed, ignored = [], [], []
+    google_user_ids, customer_ids = set(), set()
+    for event in events:
+        update = subscription_update(event)
+        if update is None:
+            ignored.append(event["_id"])
+            continue
+        updates.append(update)
+        processed.append(event["_id"])
+        if event["object"].get("client_reference_id"):
+            google_user_ids.add(event["object"]["client_reference_id"])
+        else:
+            customer_ids.add(event["object"]["customer"])
+    if updates:
+        before = await User.get_subscriber_flags(google_user_ids, customer_ids)
+        await User.bulk_update(updates)
+        # Session tokens carry the subscription tier, so users whose tier changed sign
+        # in again; renewals and failed payments leave their sessions alone
+        after = await User.get_subscriber_flags(google_user_ids, customer_ids)
+        changed = [gid for gid, is_subscriber in after.items() if before.get(gid, False) != is_subscriber]
+        await sessions.revoke(changed)
+    await StripeEvents.mark(processed, ignored)
+    logger.info(f"Applied {len(processed)} Stripe events, ignored {len(ignored)}")
+    return len(events)
+
+
+async def drain(batch_size: int = STRIPE_EVENT_BATCH_SIZE):
+    while await process_pending(batch_size) == batch_size:
+        pass
+
+
+async def run_consumer(interval: float = STRIPE_EVENT_POLL_INTERVAL):
+    while True:
+        try:
+            await asyncio.wait_for(_wakeup.wait(), interval)
+            # Let a burst of deliveries accumulate into one bulk_write
+            await asyncio.sleep(STRIPE_EVENT_BATCH_WAIT_MS / 1000)
+        except asyncio.TimeoutError:
+            pass
+        _wakeup.clear()
+        try:
+            await drain()
+        except errors.PyMongoError as e:
+            # Events stay pending and are retried on the next pass
+            logger.error(f"Error applying Stripe events: {e}")
+
+
+async def replay(since: datetime = None, types: list = None):
+    count = await StripeEvents.replay(since, types)
+    await drain()
+    return count
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Stripe event log tooling")
+    commands = parser.add_subparsers(dest="command", required=True)
+    replay_parser = commands.add_parser("replay")
+    replay_parser.add_argument("--since", type=datetime.fromisoformat, help="only events created at or after this time")
+    replay_parser.add_argument("--type", action="append", dest="types", help="only events of this type (repeatable)")
+    commands.add_parser("apply", help="apply pending events once and exit")
+    args = parser.parse_args()
+
+    if args.command == "replay":
+        since = args.since
+        if since is not None and since.tzinfo is None:
+            since = since.replace(tzinfo=timezone.utc)
+        asyncio.run(replay(since, args.types))
+    else:
+        asyncio.run(drain())
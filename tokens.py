@@ -0,0 +1,53 @@
+import os
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Tokenizer used for history and prompt budgets; falls back to a character estimate
+TOKENIZER_MODEL = os.getenv("TOKENIZER_MODEL", "gpt-4o-mini")
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+_encoding = None
+_encoding_loaded = False
+
+
+def get_encoding():
+    # Loaded on first use: tiktoken may need to download the encoding file
+    global _encoding, _encoding_loaded
+    if not _encoding_loaded:
+        _encoding_loaded = True
+        if tiktoken is None:
+            logger.warning("tiktoken is not installed, token counts are estimated from text length")
+            return None
+        try:
+            try:
+                encoding_name = tiktoken.encoding_name_for_model(TOKENIZER_MODEL)
+            except KeyError:
+                encoding_name = "o200k_base"
+            _encoding = tiktoken.get_encoding(encoding_name)
+        except Exception as e:
+            logger.warning(f"Could not load tokenizer for {TOKENIZER_MODEL}, estimating token counts: {e}")
+    return _encoding
+
+
+def count_tokens(text: str) -> int:
+    if not text:
+        return 0
+    encoding = get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    return len(text) // 4 + 1
+
+
+def truncate_tokens(text: str, max_tokens: int) -> str:
+    if max_tokens <= 0 or not text:
+        return ""
+    encoding = get_encoding()
+    if encoding is None:
+        return text[:max_tokens * 4]
+    ids = encoding.encode(text, disallowed_special=())
+    return text if len(ids) <= max_tokens else encoding.decode(ids[:max_tokens])
@@ -0,0 +1,41 @@
+import os
+import signal
+import asyncio
+import logging
+from dotenv import load_dotenv
+from query import ainit_rag, memory
+from jobs import MongoJobQueue, run_workers
+
+# Background job worker: runs queries submitted through POST /jobs. Scale it
+# independently of the web processes (see the worker entry in the Procfile).
+
+# Load environment variables and initialize logging
+load_dotenv()
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Jobs run concurrently per worker process
+JOB_WORKER_CONCURRENCY = int(os.getenv("JOB_WORKER_CONCURRENCY", "4"))
+
+
+async def main():
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+
+    await ainit_rag()
+    writer = asyncio.create_task(memory.run_write_behind()) if memory.collection is not None else None
+    logger.info(f"Job worker started with concurrency {JOB_WORKER_CONCURRENCY}")
+    try:
+        # Returns once stop is set and the running jobs have finished
+        await run_workers(MongoJobQueue(), JOB_WORKER_CONCURRENCY, stop)
+    finally:
+        if writer is not None:
+            writer.cancel()
+        await memory.flush()
+        logger.info("Job worker stopped")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())